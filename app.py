@@ -6,14 +6,26 @@
 # -------------------------------------------------------------
 
 import os
+import re
+import csv
 import calendar
+import difflib
+import tempfile
+import unicodedata
+import uuid
+from html import escape
 from datetime import date, time as dtime, datetime, timedelta
 from typing import Optional
 
 import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
-from sqlmodel import SQLModel, Field, Relationship, Session, create_engine, select, func
+from sqlmodel import SQLModel, Field, Relationship, Session, create_engine, select, func, text
+from sqlalchemy import Date, Index, and_, case, event, literal, or_, true, union_all, update, delete, insert, inspect as sa_inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 
 # Try to load .env file, but don't fail if dotenv is not available
 try:
@@ -26,7 +38,12 @@ except ImportError:
 APP_TITLE = "Nehir Atölye Yönetim"
 DEFAULT_DB = "sqlite:///nehir.db"  # env yoksa SQLite
 DATABASE_URL = os.getenv("DATABASE_URL", DEFAULT_DB)
-ENGINE = create_engine(DATABASE_URL, echo=False)
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))  # sn: yazım kilidi için bekleme
+ENGINE = create_engine(
+    DATABASE_URL, echo=False,
+    connect_args={"timeout": SQLITE_BUSY_TIMEOUT} if DATABASE_URL.startswith("sqlite") else {},
+)
+IS_POSTGRES = ENGINE.dialect.name == "postgresql"
 
 DEFAULT_PRICE_COURSE = 500.0
 DEFAULT_PRICE_BOYAMA = 250.0
@@ -35,6 +52,16 @@ DEFAULT_CAPACITY = 16
 # Açılış kasası (opsiyonel): setx / export OPENING_CASH=1000
 OPENING_CASH = float(os.getenv("OPENING_CASH", "0"))
 
+# Dışa aktarımda DB'den tek seferde çekilen satır sayısı (bellek üst sınırı)
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "5000"))
+
+# Dashboard KPI cache süresi (sn) – uygulamanın kendi yazımları cache'i ayrıca geçersiz kılar
+KPI_CACHE_TTL = int(os.getenv("KPI_CACHE_TTL", "60"))
+
+# data_version() anahtarlı cache'ler her yazımda yeni giriş üretir: eski sürümler bu sınırlarla atılır
+VERSIONED_CACHE_TTL = int(os.getenv("VERSIONED_CACHE_TTL", "3600"))
+VERSIONED_CACHE_MAX = int(os.getenv("VERSIONED_CACHE_MAX", "16"))
+
 # ============================ THEME ============================
 def load_theme():
     # Force cache refresh with timestamp
@@ -555,6 +582,8 @@ def get_models():
         first_visit: Optional[date] = None
         notes: Optional[str] = None
         is_active: bool = Field(default=True)
+        search_key: Optional[str] = Field(default=None, index=True)  # normalize isim + telefon rakamları
+        phone_e164: Optional[str] = Field(default=None, index=True)  # mükerrer tespiti için normalize telefon
 
     class Course(SQLModel, table=True):
         __tablename__ = "course"
@@ -569,7 +598,10 @@ def get_models():
 
     class SessionModel(SQLModel, table=True):
         __tablename__ = "sessionmodel"
-        __table_args__ = {"extend_existing": True}
+        __table_args__ = (
+            Index("ix_sessionmodel_date_start", "date", "start_time"),  # takvim/ajanda tarih aralığı
+            {"extend_existing": True},
+        )
 
         id: Optional[int] = Field(default=None, primary_key=True)
         course_id: int = Field(foreign_key="course.id")
@@ -579,10 +611,17 @@ def get_models():
         capacity: int = Field(default=DEFAULT_CAPACITY)
         price_override: Optional[float] = None
         notes: Optional[str] = None
+        series_id: Optional[str] = Field(default=None, index=True)  # tekrarlayan seri (create_series)
+        registered_count: int = Field(default=0)  # kayıt yazımlarıyla güncellenen sayaçlar (refresh_seat_counts)
+        attended_count: int = Field(default=0)
 
     class Enrollment(SQLModel, table=True):
         __tablename__ = "enrollment"
-        __table_args__ = {"extend_existing": True}
+        __table_args__ = (
+            Index("uq_enrollment_person_session", "person_id", "session_id", unique=True),
+            Index("ix_enrollment_session_status_id", "session_id", "status", "id"),  # bekleme listesi sırası
+            {"extend_existing": True},
+        )
 
         id: Optional[int] = Field(default=None, primary_key=True)
         person_id: int = Field(foreign_key="person.id")
@@ -654,6 +693,9 @@ def get_models():
         color_code: Optional[str] = None
         min_level: Optional[float] = None
         is_active: bool = Field(default=True)
+        # Sürekli (perpetual) ağırlıklı ortalama maliyet durumu – her StockMovement ile güncellenir
+        on_hand_qty: Optional[float] = Field(default=0.0)
+        avg_cost: Optional[float] = None
 
     class StockMovement(SQLModel, table=True):
         __tablename__ = "stock_movement"
@@ -668,6 +710,8 @@ def get_models():
         session_id: Optional[int] = Field(default=None, foreign_key="sessionmodel.id")
         date_: date = Field(default_factory=lambda: date.today())
         note: Optional[str] = None
+        cost_basis: Optional[float] = None  # hareket anındaki birim maliyet ('in': alış, diğer: WAC)
+        avg_cost_after: Optional[float] = None  # hareket sonrası WAC
 
     class DailyNote(SQLModel, table=True):
         __tablename__ = "daily_note"
@@ -679,6 +723,56 @@ def get_models():
         created_at: datetime = Field(default_factory=datetime.now)
         updated_at: datetime = Field(default_factory=datetime.now)
 
+    class WalletBalance(SQLModel, table=True):
+        """Kişi başı cüzdan projeksiyonu – Payment/Charge yazımlarıyla aynı transaction'da güncellenir."""
+        __tablename__ = "wallet_balance"
+        __table_args__ = {"extend_existing": True}
+
+        person_id: int = Field(foreign_key="person.id", primary_key=True)
+        balance: float = Field(default=0.0)
+        updated_at: datetime = Field(default_factory=datetime.now)
+
+    class CashClosing(SQLModel, table=True):
+        """Günlük kasa kapanışı – gün sonu nakit bakiyesi (checkpoint)."""
+        __tablename__ = "cash_closing"
+        __table_args__ = {"extend_existing": True}
+
+        date_: date = Field(primary_key=True)
+        closing_balance: float
+        created_at: datetime = Field(default_factory=datetime.now)
+
+    class InventorySnapshot(SQLModel, table=True):
+        """Dönem sonu (ay sonu) malzeme başı stok miktarı ve değeri."""
+        __tablename__ = "inventory_snapshot"
+        __table_args__ = {"extend_existing": True}
+
+        material_id: int = Field(foreign_key="material.id", primary_key=True)
+        period_end: date = Field(primary_key=True, index=True)
+        qty: float = Field(default=0.0)
+        value: float = Field(default=0.0)
+        created_at: datetime = Field(default_factory=datetime.now)
+
+    class DailyKpi(SQLModel, table=True):
+        """Günlük KPI rollup – yazımlarla artımlı güncellenir, backfill_daily_kpi() ile yeniden kurulur."""
+        __tablename__ = "daily_kpi"
+        __table_args__ = {"extend_existing": True}
+
+        day: date = Field(primary_key=True)
+        cash_in: float = Field(default=0.0)
+        iban_in: float = Field(default=0.0)
+        expenses: float = Field(default=0.0)
+        attendees: int = Field(default=0)  # 'attended' kayıt sayısı (seans-kişi)
+        new_persons: int = Field(default=0)
+        pieces_delivered: int = Field(default=0)
+
+    class PersonNameToken(SQLModel, table=True):
+        """Mükerrer tespiti için blok indeksi: normalize isim kelimesi → kişi."""
+        __tablename__ = "person_name_token"
+        __table_args__ = {"extend_existing": True}
+
+        token: str = Field(primary_key=True)
+        person_id: int = Field(foreign_key="person.id", primary_key=True, index=True)
+
     return {
         'Person': Person,
         'Course': Course, 
@@ -690,7 +784,12 @@ def get_models():
         'Piece': Piece,
         'Material': Material,
         'StockMovement': StockMovement,
-        'DailyNote': DailyNote
+        'DailyNote': DailyNote,
+        'WalletBalance': WalletBalance,
+        'CashClosing': CashClosing,
+        'InventorySnapshot': InventorySnapshot,
+        'DailyKpi': DailyKpi,
+        'PersonNameToken': PersonNameToken
     }
 
 # Get cached models - use these throughout the app
@@ -706,30 +805,111 @@ Piece = MODELS['Piece']
 Material = MODELS['Material']
 StockMovement = MODELS['StockMovement']
 DailyNote = MODELS['DailyNote']
+WalletBalance = MODELS['WalletBalance']
+CashClosing = MODELS['CashClosing']
+InventorySnapshot = MODELS['InventorySnapshot']
+DailyKpi = MODELS['DailyKpi']
+PersonNameToken = MODELS['PersonNameToken']
 
 # Skip all duplicate model definitions below - use cached models only
 
 # ============================ DB INIT ============================
+@st.cache_resource
 def init_db():
-    """Initialize database - clear metadata first to prevent duplicates"""
-    try:
-        # Clear any existing metadata to prevent duplicates
-        SQLModel.metadata.clear()
-        # Recreate tables
-        SQLModel.metadata.create_all(ENGINE)
-    except Exception as e:
-        # If there's an error, just try creating tables normally
-        SQLModel.metadata.create_all(ENGINE)
+    """Initialize database once per process.
+
+    Tablolar cache'li modellerden açıkça oluşturulur (metadata.clear() sonrası
+    create_all boş kalmasın); yeni eklenen projeksiyon tabloları ham kayıtlardan doldurulur.
+    """
+    existing = set(sa_inspect(ENGINE).get_table_names())
+    SQLModel.metadata.create_all(ENGINE, tables=[m.__table__ for m in MODELS.values()])
+    added = ensure_columns()
+    if WalletBalance.__tablename__ not in existing:
+        reconcile_wallet_balances()
+    if DailyKpi.__tablename__ not in existing or daily_kpi_expense_drift():
+        backfill_daily_kpi()
+    if ("material", "on_hand_qty") in added:
+        rebuild_material_costs()
+    if {("person", "search_key"), ("person", "phone_e164")} & added or PersonNameToken.__tablename__ not in existing:
+        rebuild_person_keys()
+    if ("sessionmodel", "registered_count") in added:
+        with get_session() as s:
+            refresh_seat_counts(s)
+            s.commit()
+    ensure_search_index()
+    ensure_indexes()
+
+# Var olan tablolara sonradan eklenen kolonlar (create_all mevcut tabloyu değiştirmez)
+SCHEMA_ADDITIONS = [
+    (Person, "search_key"),
+    (Person, "phone_e164"),
+    (SessionModel, "series_id"),
+    (SessionModel, "registered_count"),
+    (SessionModel, "attended_count"),
+    (Material, "on_hand_qty"),
+    (Material, "avg_cost"),
+    (StockMovement, "cost_basis"),
+    (StockMovement, "avg_cost_after"),
+]
+
+def ensure_columns() -> set:
+    """Eksik kolonları ALTER TABLE ile ekler; eklenen (tablo, kolon) çiftlerini döner."""
+    insp = sa_inspect(ENGINE)
+    added = set()
+    with ENGINE.begin() as conn:
+        for model, name in SCHEMA_ADDITIONS:
+            table = model.__tablename__
+            if name in {c["name"] for c in insp.get_columns(table)}:
+                continue
+            ddl = model.__table__.c[name].type.compile(dialect=ENGINE.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+            for idx in model.__table__.indexes:
+                if name in idx.columns:
+                    idx.create(conn, checkfirst=True)
+            added.add((table, name))
+    return added
 
 def get_session() -> Session:
     return Session(ENGINE)
 
+def upsert_insert(model):
+    """ON CONFLICT destekli INSERT (Postgres / SQLite ≥ 3.24) – ilk satırı aynı anda yaratan yazıcılar çakışmaz."""
+    return pg_insert(model) if IS_POSTGRES else sqlite_insert(model)
+
+# --------- Veri sürümü: yazım yapan her commit sürümü artırır (cache anahtarı) ---------
+@st.cache_resource
+def _data_version_box() -> dict:
+    return {"v": 0}
+
+def data_version() -> int:
+    return _data_version_box()["v"]
+
+def bump_data_version():
+    _data_version_box()["v"] += 1
+
+def _mark_session_wrote(session, flush_context):
+    session.info["wrote"] = True
+
+def _mark_session_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+def _bump_on_commit(session):
+    if session.info.pop("wrote", False):
+        bump_data_version()
+
+def _clear_on_rollback(session):
+    session.info.pop("wrote", None)
+
 # ============================ HELPERS ============================
 METHOD_CHOICES = ["cash", "iban"]
-STATUS_CHOICES = ["registered", "attended", "canceled", "no_show"]
+STATUS_CHOICES = ["registered", "attended", "canceled", "no_show", "waitlist"]
 STAGE_CHOICES = ["clay", "bisque", "glaze", "fired", "delivered"]
 MAT_CAT = ["clay", "glaze", "paint", "tool", "consumable"]
 UNITS = ["kg", "L", "pcs"]
+ACTIVE_STATUSES = ["registered", "attended"]  # koltuk tutan kayıtlar
+WEEKDAYS_TR = ['Pazartesi', 'Salı', 'Çarşamba', 'Perşembe', 'Cuma', 'Cumartesi', 'Pazar']
+MONTHS_TR = ['', 'Ocak', 'Şubat', 'Mart', 'Nisan', 'Mayıs', 'Haziran', 'Temmuz', 'Ağustos', 'Eylül', 'Ekim', 'Kasım', 'Aralık']  # calendar.month_name gibi 1'den
 
 def price_for_enrollment(e, s, c) -> float:
     if e.price_override is not None:
@@ -738,6 +918,1115 @@ def price_for_enrollment(e, s, c) -> float:
         return float(s.price_override)
     return float(c.default_price or 0.0)
 
+# --------- Günlük KPI rollup ---------
+DAILY_KPI_FIELDS = ("cash_in", "iban_in", "expenses", "attendees", "new_persons", "pieces_delivered")
+
+def bump_daily_kpi(s: Session, day: date, **deltas):
+    """daily_kpi satırına artımlı ekleme (çağıranın transaction'ında, tek INSERT ... ON CONFLICT)."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    stmt = upsert_insert(DailyKpi).values(day=day, **{k: deltas.get(k, 0) for k in DAILY_KPI_FIELDS})
+    s.exec(stmt.on_conflict_do_update(
+        index_elements=[DailyKpi.day],
+        set_={k: getattr(DailyKpi, k) + getattr(stmt.excluded, k) for k in deltas},
+    ))
+
+def backfill_daily_kpi() -> int:
+    """Rollup'ı işlem tablolarından gün bazında GROUP BY sorgularıyla yeniden kurar."""
+    days = {}
+    def merge(rows, field):
+        for day, val in rows:
+            if day is not None:
+                day = day if isinstance(day, date) else date.fromisoformat(str(day))
+                days.setdefault(day, {})[field] = val or 0
+    with get_session() as s:
+        for method, field in (("cash", "cash_in"), ("iban", "iban_in")):
+            merge(s.exec(select(Payment.date_, func.sum(Payment.amount))
+                         .where(Payment.cleared == True, Payment.method == method)  # noqa: E712
+                         .group_by(Payment.date_)).all(), field)
+        merge(s.exec(select(Expense.date_, func.sum(Expense.amount))
+                     .where(Expense.paid_from == "cash").group_by(Expense.date_)).all(), "expenses")
+        merge(s.exec(select(SessionModel.date, func.count(Enrollment.id))
+                     .join(SessionModel, SessionModel.id == Enrollment.session_id)
+                     .where(Enrollment.status == "attended").group_by(SessionModel.date)).all(), "attendees")
+        merge(s.exec(select(Person.first_visit, func.count(Person.id)).group_by(Person.first_visit)).all(), "new_persons")
+        delivered_day = func.date(Piece.delivered_at)
+        merge(s.exec(select(delivered_day, func.count(Piece.id))
+                     .where(Piece.delivered == True, Piece.delivered_at.is_not(None))  # noqa: E712
+                     .group_by(delivered_day)).all(), "pieces_delivered")
+        s.exec(delete(DailyKpi))
+        if days:
+            s.exec(insert(DailyKpi), params=[
+                {"day": day, **{k: vals.get(k, 0) for k in DAILY_KPI_FIELDS}} for day, vals in days.items()
+            ])
+        s.commit()
+    return len(days)
+
+def daily_kpi_expense_drift() -> bool:
+    """Rollup'taki harcama toplamı kasadan harcamalarla tutmuyorsa True (eski rollup tüm harcamaları sayıyordu)."""
+    with get_session() as s:
+        rolled = s.exec(select(func.coalesce(func.sum(DailyKpi.expenses), 0))).one()
+        actual = s.exec(select(func.coalesce(func.sum(Expense.amount), 0)).where(Expense.paid_from == "cash")).one()
+    return round(rolled, 2) != round(actual, 2)
+
+def daily_kpi_totals(d1: date, d2: date) -> dict:
+    """[d1, d2] aralığının rollup toplamları – daily_kpi üzerinde tek SUM."""
+    with get_session() as s:
+        row = s.exec(
+            select(*[func.sum(getattr(DailyKpi, k)) for k in DAILY_KPI_FIELDS])
+            .where(DailyKpi.day >= d1, DailyKpi.day <= d2)
+        ).one()
+    return {k: (v or 0) for k, v in zip(DAILY_KPI_FIELDS, row)}
+
+@st.cache_data(ttl=KPI_CACHE_TTL, show_spinner=False)
+def kpi_trends(today: date, version: int) -> dict:
+    """Bugün vs dün – daily_kpi'dan iki satır + günlük tekil katılımcı sayısı."""
+    yesterday = today - timedelta(days=1)
+    with get_session() as s:
+        rows = {r.day: r for r in s.exec(select(DailyKpi).where(DailyKpi.day.in_([today, yesterday]))).all()}
+        unique = dict(s.exec(
+            select(SessionModel.date, func.count(func.distinct(Enrollment.person_id)))
+            .join(SessionModel, SessionModel.id == Enrollment.session_id)
+            .where(Enrollment.status == "attended", SessionModel.date.in_([today, yesterday]))
+            .group_by(SessionModel.date)
+        ).all())
+    def vals(day):
+        r = rows.get(day)
+        return {**{k: (getattr(r, k) if r else 0) for k in DAILY_KPI_FIELDS}, "unique_attendees": unique.get(day, 0)}
+    return {"today": vals(today), "yesterday": vals(yesterday)}
+
+def _trend_badge(cur: float, prev: float, unit: str = "%") -> str:
+    """KPI kartı trend rozeti: unit='%' yüzde, aksi halde mutlak fark + birim."""
+    diff = cur - prev
+    cls, arrow = ("up", "↗") if diff >= 0 else ("down", "↘")
+    if unit == "%":
+        text = "yeni" if prev == 0 and cur else (f"{diff / abs(prev) * 100:+.1f}%" if prev else "±0%")
+    else:
+        text = f"{diff:+,.0f} {unit}"
+    return f'<div class="kpi-trend {cls}">{arrow} {text}</div>'
+
+# --------- Dönem raporları (GROUP BY SQL'de, pivot pandas'ta) ---------
+REPORT_BUCKETS = {"day": "Gün", "week": "Hafta", "month": "Ay"}
+
+def _date_bucket(col, bucket: str):
+    """Tarih kolonunu gün/hafta (Pazartesi)/ay başına yuvarlayan SQL ifadesi."""
+    if bucket == "day":
+        return col
+    if IS_POSTGRES:
+        return func.date_trunc(bucket, col).cast(Date)
+    if bucket == "week":
+        return func.date(col, "weekday 0", "-6 days")
+    return func.strftime("%Y-%m-01", col)
+
+def _frame(s: Session, stmt, columns: list) -> pd.DataFrame:
+    df = pd.DataFrame(s.exec(stmt).all(), columns=columns)
+    if not df.empty:
+        df["Dönem"] = pd.to_datetime(df["Dönem"]).dt.date
+    return df
+
+def session_revenue_subquery():
+    """Seans başı borç (gelir) toplamı – dönem ve doluluk raporları aynı tanımı kullanır."""
+    return (
+        select(Charge.session_id, func.sum(Charge.amount).label("amount"))
+        .where(Charge.session_id.is_not(None)).group_by(Charge.session_id).subquery()
+    )
+
+def report_frames(d1: date, d2: date, bucket: str = "day") -> dict:
+    """[d1, d2] için dönem × boyut toplamları – her tablo için tek GROUP BY sorgusu.
+
+    Dönüş: {"payments", "expenses", "courses"} → uzun formatlı DataFrame'ler.
+    """
+    pb = _date_bucket(Payment.date_, bucket).label("bucket")
+    eb = _date_bucket(Expense.date_, bucket).label("bucket")
+    sb = _date_bucket(SessionModel.date, bucket).label("bucket")
+    with get_session() as s:
+        payments = _frame(s, select(pb, Payment.method, func.sum(Payment.amount), func.count(Payment.id))
+                          .where(Payment.date_ >= d1, Payment.date_ <= d2, Payment.cleared == True)  # noqa: E712
+                          .group_by(pb, Payment.method),
+                          ["Dönem", "Yöntem", "Tutar", "Adet"])
+        expenses = _frame(s, select(eb, Expense.category, func.sum(Expense.amount), func.count(Expense.id))
+                          .where(Expense.date_ >= d1, Expense.date_ <= d2)
+                          .group_by(eb, Expense.category),
+                          ["Dönem", "Kategori", "Tutar", "Adet"])
+        # Seans başı ön-toplamlar (join çoğalmasını önler)
+        attended = (
+            select(Enrollment.session_id, func.count(Enrollment.id).label("n"))
+            .where(Enrollment.status == "attended").group_by(Enrollment.session_id).subquery()
+        )
+        charged = session_revenue_subquery()
+        courses = _frame(s, select(
+                            sb, Course.name, func.count(SessionModel.id),
+                            func.coalesce(func.sum(attended.c.n), 0),
+                            func.coalesce(func.sum(charged.c.amount), 0.0),
+                         )
+                         .select_from(SessionModel)
+                         .join(Course, Course.id == SessionModel.course_id)
+                         .outerjoin(attended, attended.c.session_id == SessionModel.id)
+                         .outerjoin(charged, charged.c.session_id == SessionModel.id)
+                         .where(SessionModel.date >= d1, SessionModel.date <= d2)
+                         .group_by(sb, Course.name),
+                         ["Dönem", "Ders", "Seans", "Katılım", "Gelir"])
+    return {"payments": payments, "expenses": expenses, "courses": courses}
+
+def _pivot(df: pd.DataFrame, columns: str, values: str) -> pd.DataFrame:
+    if df.empty:
+        return df
+    pv = pd.pivot_table(df, index="Dönem", columns=columns, values=values, aggfunc="sum", fill_value=0)
+    pv["Toplam"] = pv.sum(axis=1)
+    return pv.sort_index()
+
+# --------- Doluluk / kullanım analizi ---------
+def occupancy_frame(d1: date, d2: date) -> pd.DataFrame:
+    """Seans başı kayıt/katılım/no-show/gelir – tek GROUP BY (seans ⟕ kayıt) + ön-toplanmış borçlar."""
+    charged = session_revenue_subquery()
+    revenue = func.coalesce(func.max(charged.c.amount), 0.0)
+    stmt = (
+        select(
+            SessionModel.id, SessionModel.date, SessionModel.start_time, Course.name, SessionModel.capacity,
+            func.count(Enrollment.id).filter(Enrollment.status.in_(ACTIVE_STATUSES)),
+            func.count(Enrollment.id).filter(Enrollment.status == "attended"),
+            func.count(Enrollment.id).filter(Enrollment.status == "no_show"),
+            revenue,
+        )
+        .select_from(SessionModel)
+        .join(Course, Course.id == SessionModel.course_id)
+        .outerjoin(Enrollment, Enrollment.session_id == SessionModel.id)
+        .outerjoin(charged, charged.c.session_id == SessionModel.id)
+        .where(SessionModel.date >= d1, SessionModel.date <= d2)
+        .group_by(SessionModel.id, SessionModel.date, SessionModel.start_time, Course.name, SessionModel.capacity)
+    )
+    with get_session() as s:
+        df = pd.DataFrame(s.exec(stmt).all(), columns=[
+            "Seans", "Tarih", "Başlangıç", "Ders", "Kapasite", "Kayıtlı", "Katılan", "No-show", "Gelir",
+        ])
+    if df.empty:
+        return df
+    dates = pd.to_datetime(df["Tarih"])
+    df["Gün"] = pd.Categorical(dates.dt.dayofweek.map(dict(enumerate(WEEKDAYS_TR))), categories=WEEKDAYS_TR, ordered=True)
+    df["Saat"] = df["Başlangıç"].map(lambda t: t.strftime("%H:%M"))
+    df["Ay"] = dates.dt.strftime("%Y-%m")
+    return df
+
+def occupancy_summary(df: pd.DataFrame, by: list) -> pd.DataFrame:
+    """Doluluk, katılım, no-show oranı ve koltuk başı gelir – vektörel groupby."""
+    g = df.groupby(by, observed=True)[["Kapasite", "Kayıtlı", "Katılan", "No-show", "Gelir"]].sum()
+    g.insert(0, "Seans", df.groupby(by, observed=True)["Seans"].count())
+    g["Doluluk %"] = (g["Kayıtlı"] / g["Kapasite"] * 100).round(1)
+    g["Katılım %"] = (g["Katılan"] / g["Kapasite"] * 100).round(1)
+    shown = g["Katılan"] + g["No-show"]
+    g["No-show %"] = (g["No-show"] / shown.where(shown > 0) * 100).round(1).fillna(0.0)
+    g["Gelir/Koltuk"] = (g["Gelir"] / g["Kapasite"]).round(2)
+    return g
+
+# --------- Kohort (tutundurma) analizi ---------
+@st.cache_data(ttl=VERSIONED_CACHE_TTL, max_entries=VERSIONED_CACHE_MAX, show_spinner=False)
+def cohort_matrix(version: int, course_id: Optional[int] = None) -> dict:
+    """İlk geliş ayı × geçen ay kohort matrisi – tek SQL çekimi + vektörel pandas/NumPy.
+
+    version=data_version() ile cache'lenir; yazım olmadıkça yeniden hesaplanmaz.
+    Dönüş: {"counts": aktif kişi sayıları, "retention": kohort büyüklüğüne oran (%)}
+    """
+    month = _date_bucket(SessionModel.date, "month").label("month")
+    stmt = (
+        select(Enrollment.person_id, Person.first_visit, month)
+        .join(SessionModel, SessionModel.id == Enrollment.session_id)
+        .join(Person, Person.id == Enrollment.person_id)
+        .where(Enrollment.status == "attended")
+        .group_by(Enrollment.person_id, Person.first_visit, month)
+    )
+    if course_id is not None:
+        stmt = stmt.where(SessionModel.course_id == course_id)
+    with get_session() as s:
+        df = pd.DataFrame(s.exec(stmt).all(), columns=["person_id", "first_visit", "month"])
+    if df.empty:
+        return {"counts": pd.DataFrame(), "retention": pd.DataFrame()}
+    active = pd.to_datetime(df["month"]).dt.to_period("M")
+    first_seen = active.groupby(df["person_id"]).transform("min")
+    first_visit = pd.to_datetime(df["first_visit"]).dt.to_period("M")
+    # first_visit boşsa ya da ilk katılımdan sonraysa ilk katılım ayı kohort sayılır
+    cohort = first_visit.where(first_visit.notna() & (first_visit <= first_seen), first_seen)
+    age = (active.dt.year.to_numpy() - cohort.dt.year.to_numpy()) * 12 + (active.dt.month.to_numpy() - cohort.dt.month.to_numpy())
+    frame = pd.DataFrame({"Kohort": cohort.astype(str), "Ay": age, "person_id": df["person_id"]})
+    counts = frame.pivot_table(index="Kohort", columns="Ay", values="person_id", aggfunc="nunique", fill_value=0)
+    size = frame.groupby("Kohort")["person_id"].nunique()
+    retention = (counts.div(size, axis=0) * 100).round(1)
+    counts.insert(0, "Kişi", size)
+    return {"counts": counts, "retention": retention}
+
+# --------- Dışa aktarım (parça parça akış: CSV / Parquet) ---------
+EXPORT_KINDS = {"payments": "Tahsilatlar", "expenses": "Harcamalar", "charges": "Borçlar", "stock": "Stok Hareketleri"}
+
+def export_statement(kind: str, d1: date, d2: date):
+    """Dışa aktarılacak kolonlar – tarih ve id sırasıyla, ORM nesnesi yüklemeden."""
+    if kind == "payments":
+        return (select(Payment.id, Payment.date_.label("tarih"), Person.name.label("kisi"), Payment.amount.label("tutar"),
+                       Payment.method.label("yontem"), Payment.cleared.label("onayli"), Payment.note.label("not"))
+                .join(Person, Person.id == Payment.person_id)
+                .where(Payment.date_ >= d1, Payment.date_ <= d2).order_by(Payment.date_, Payment.id))
+    if kind == "expenses":
+        return (select(Expense.id, Expense.date_.label("tarih"), Expense.category.label("kategori"),
+                       Expense.paid_from.label("kaynak"), Expense.amount.label("tutar"), Expense.note.label("not"))
+                .where(Expense.date_ >= d1, Expense.date_ <= d2).order_by(Expense.date_, Expense.id))
+    if kind == "charges":
+        return (select(Charge.id, Charge.date_.label("tarih"), Person.name.label("kisi"), Charge.session_id.label("seans"),
+                       Charge.amount.label("tutar"), Charge.note.label("not"))
+                .join(Person, Person.id == Charge.person_id)
+                .where(Charge.date_ >= d1, Charge.date_ <= d2).order_by(Charge.date_, Charge.id))
+    if kind == "stock":
+        return (select(StockMovement.id, StockMovement.date_.label("tarih"), Material.name.label("malzeme"),
+                       StockMovement.direction.label("yon"), StockMovement.qty.label("miktar"),
+                       StockMovement.unit_cost.label("alis_maliyeti"), StockMovement.cost_basis.label("birim_maliyet"),
+                       StockMovement.source.label("kaynak"), StockMovement.note.label("not"))
+                .join(Material, Material.id == StockMovement.material_id)
+                .where(StockMovement.date_ >= d1, StockMovement.date_ <= d2).order_by(StockMovement.date_, StockMovement.id))
+    raise ValueError(f"Bilinmeyen dışa aktarım türü: {kind}")
+
+def stream_rows(stmt, chunk: int = EXPORT_CHUNK):
+    """Sonucu chunk'lar halinde üretir: Postgres'te server-side cursor, SQLite'ta fetchmany."""
+    with ENGINE.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk).execute(stmt)
+        for part in result.partitions(chunk):
+            yield part
+
+def _arrow_schema(stmt):
+    import pyarrow as pa
+    def arrow_type(col):
+        try:
+            py = col.type.python_type
+        except NotImplementedError:
+            py = str
+        return {float: pa.float64(), int: pa.int64(), bool: pa.bool_(), date: pa.date32()}.get(py, pa.string())
+    return pa.schema([(col.name, arrow_type(col)) for col in stmt.selected_columns])
+
+def write_export(stmt, fmt: str) -> str:
+    """Sorguyu chunk chunk geçici dosyaya yazar (bellekte en fazla bir chunk); dosya yolunu döner.
+
+    Dosyayı silmek çağırana aittir. Hata olursa (pyarrow yok, yazım yarıda kaldı) geçici dosya silinir ve hata yükseltilir.
+    """
+    if fmt not in ("csv", "parquet"):
+        raise ValueError(f"Bilinmeyen format: {fmt}")
+    names = [col.name for col in stmt.selected_columns]
+    fd, path = tempfile.mkstemp(prefix="nehir_export_", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        if fmt == "csv":
+            with open(path, "w", newline="", encoding="utf-8-sig") as fh:
+                writer = csv.writer(fh)
+                writer.writerow(names)
+                for part in stream_rows(stmt):
+                    writer.writerows(part)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = _arrow_schema(stmt)
+            with pq.ParquetWriter(path, schema) as writer:
+                for part in stream_rows(stmt):
+                    writer.write_table(pa.Table.from_pylist([dict(zip(names, row)) for row in part], schema=schema))
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+# --------- Kişi arama (Türkçe normalize anahtar + indeks) ---------
+_TR_FOLD = str.maketrans({"İ": "i", "I": "ı"})
+
+def normalize_text(text: Optional[str]) -> str:
+    """Türkçe büyük/küçük harf katlama + aksan temizleme: 'İĞNE Işık' → 'igne isik'."""
+    text = (text or "").translate(_TR_FOLD).lower().replace("ı", "i")
+    text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+def person_search_key(name: Optional[str], phone: Optional[str]) -> str:
+    digits = re.sub(r"\D", "", phone or "")
+    return f"{normalize_text(name)} {digits}".strip()
+
+DEFAULT_COUNTRY_CODE = "90"
+NAME_STOPWORDS = {"ve", "ile"}
+
+def normalize_phone(raw: Optional[str]) -> Optional[str]:
+    """Telefonu E.164'e çevirir: '0532 123 45 67', '532-123-4567', '+90 532…' → '+905321234567'."""
+    if not raw:
+        return None
+    digits = re.sub(r"\D", "", raw)
+    if not digits:
+        return None
+    if raw.strip().startswith("+"):
+        return "+" + digits
+    if digits.startswith("00"):
+        return "+" + digits[2:]
+    if digits.startswith(DEFAULT_COUNTRY_CODE) and len(digits) == 12:
+        return "+" + digits
+    if digits.startswith("0") and len(digits) == 11:
+        return "+" + DEFAULT_COUNTRY_CODE + digits[1:]
+    if len(digits) == 10:
+        return "+" + DEFAULT_COUNTRY_CODE + digits
+    return "+" + digits  # tanınmayan biçim: rakamlar korunur
+
+def name_tokens(name: Optional[str]) -> set:
+    return {t for t in normalize_text(name).split() if len(t) > 1 and t not in NAME_STOPWORDS}
+
+def _person_search_key(mapper, connection, target):
+    target.search_key = person_search_key(target.name, target.phone)
+    target.phone_e164 = normalize_phone(target.phone)
+
+def _person_name_tokens(mapper, connection, target):
+    connection.execute(delete(PersonNameToken).where(PersonNameToken.person_id == target.id))
+    rows = [{"token": t, "person_id": target.id} for t in name_tokens(target.name)]
+    if rows:
+        connection.execute(insert(PersonNameToken), rows)
+
+def _person_name_tokens_delete(mapper, connection, target):
+    connection.execute(delete(PersonNameToken).where(PersonNameToken.person_id == target.id))
+
+def rebuild_person_keys() -> int:
+    """search_key, phone_e164 ve isim-kelime indeksini tüm kişiler için yeniden kurar."""
+    with get_session() as s:
+        rows = s.exec(select(Person.id, Person.name, Person.phone)).all()
+        s.exec(delete(PersonNameToken))
+        if rows:
+            s.exec(update(Person), params=[
+                {"id": pid, "search_key": person_search_key(n, p), "phone_e164": normalize_phone(p)} for pid, n, p in rows
+            ])
+            tokens = [{"token": t, "person_id": pid} for pid, n, _ in rows for t in name_tokens(n)]
+            if tokens:
+                s.exec(insert(PersonNameToken), params=tokens)
+        s.commit()
+    return len(rows)
+
+@st.cache_resource
+def ensure_search_index() -> str:
+    """Alt-dizi araması için indeks kurar; kullanılan yöntemi döner: 'trgm' | 'fts5' | 'like'."""
+    with ENGINE.begin() as conn:
+        # sonradan eklenen sütunlar create_all'dan indeks almaz
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_person_search_key ON person (search_key)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_person_phone_e164 ON person (phone_e164)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_person_name_id ON person (name, id)")  # keyset sayfalama
+    try:
+        with ENGINE.begin() as conn:
+            if IS_POSTGRES:
+                conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_person_search_trgm ON person USING gin (search_key gin_trgm_ops)")
+                return "trgm"
+            if ENGINE.dialect.name == "sqlite":
+                conn.exec_driver_sql(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS person_fts USING fts5("
+                    "search_key, content='person', content_rowid='id', tokenize='trigram')"
+                )
+                conn.exec_driver_sql(
+                    "CREATE TRIGGER IF NOT EXISTS person_fts_ai AFTER INSERT ON person BEGIN "
+                    "INSERT INTO person_fts(rowid, search_key) VALUES (new.id, new.search_key); END"
+                )
+                conn.exec_driver_sql(
+                    "CREATE TRIGGER IF NOT EXISTS person_fts_ad AFTER DELETE ON person BEGIN "
+                    "INSERT INTO person_fts(person_fts, rowid, search_key) VALUES ('delete', old.id, old.search_key); END"
+                )
+                conn.exec_driver_sql(
+                    "CREATE TRIGGER IF NOT EXISTS person_fts_au AFTER UPDATE ON person BEGIN "
+                    "INSERT INTO person_fts(person_fts, rowid, search_key) VALUES ('delete', old.id, old.search_key); "
+                    "INSERT INTO person_fts(rowid, search_key) VALUES (new.id, new.search_key); END"
+                )
+                conn.exec_driver_sql("INSERT INTO person_fts(person_fts) VALUES ('rebuild')")  # süreç başına bir kez: kaymaları onarır
+                return "fts5"
+    except Exception:
+        pass  # eklenti/yetki yoksa LIMIT'li LIKE'a düşülür
+    return "like"
+
+def search_people(q: str, limit: int = 50, active_only: bool = False) -> list:
+    """İsim/telefon araması: önek ve alt-dizi eşleşmesi, indeksli ve LIMIT'li."""
+    nq = normalize_text(q)
+    if nq and not re.search(r"[^\d ]", nq):
+        nq = nq.replace(" ", "")  # sadece rakam: telefon parçası
+    if not nq:
+        return []
+    backend = ensure_search_index()
+    terms = [t for t in nq.split() if len(t) >= 3]
+    with get_session() as s:
+        if backend == "fts5" and terms:
+            match = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+            # kısa terimler (<3 harf) trigram dışında kalır: LIMIT'ten önce SQL'de ayrıca süz
+            short = {f"short{i}": t for i, t in enumerate(t for t in nq.split() if len(t) < 3)}
+            stmt = select(Person).from_statement(text(
+                "SELECT person.* FROM person JOIN person_fts ON person_fts.rowid = person.id "
+                "WHERE person_fts MATCH :match" + (" AND person.is_active" if active_only else "") +
+                "".join(f" AND instr(person.search_key, :{k}) > 0" for k in short) +
+                " ORDER BY person.name LIMIT :limit"
+            ).bindparams(match=match, limit=limit, **short))
+            return list(s.exec(stmt).scalars().all())
+        if backend == "trgm" or terms:
+            conds = [Person.search_key.like(f"%{t}%") for t in nq.split()]
+        else:
+            conds = [Person.search_key >= nq, Person.search_key < nq + "\uffff"]  # önek: B-tree range
+        stmt = select(Person).where(*conds)
+        if active_only:
+            stmt = stmt.where(Person.is_active == True)  # noqa: E712
+        return list(s.exec(stmt.order_by(Person.name).limit(limit)).all())
+
+PAGE_SIZES = [25, 50, 100, 200]
+
+def people_page(s: Session, after: Optional[tuple] = None, limit: int = 50, active_only: bool = False) -> tuple:
+    """(name, id) üzerinden keyset sayfalama: OFFSET yok, her sayfa sabit maliyetli. (kişiler, sonraki_var) döner."""
+    stmt = select(Person)
+    if active_only:
+        stmt = stmt.where(Person.is_active == True)  # noqa: E712
+    if after:
+        name, pid = after
+        stmt = stmt.where(or_(Person.name > name, and_(Person.name == name, Person.id > pid)))
+    rows = s.exec(stmt.order_by(Person.name, Person.id).limit(limit + 1)).all()
+    return rows[:limit], len(rows) > limit
+
+@st.cache_data(ttl=VERSIONED_CACHE_TTL, max_entries=VERSIONED_CACHE_MAX, show_spinner=False)
+def people_count(active_only: bool, version: int) -> int:
+    """Sayfalayıcı için toplam kişi sayısı – her yeniden çalıştırmada COUNT(*) atmamak için sürümle cache'lenir."""
+    stmt = select(func.count(Person.id))
+    if active_only:
+        stmt = stmt.where(Person.is_active == True)  # noqa: E712
+    with get_session() as s:
+        return s.exec(stmt).one()
+
+# --------- Mükerrer kişi tespiti ve birleştirme ---------
+DUP_NAME_THRESHOLD = 0.85
+DUP_BLOCK_MAX = 50  # bu kadar kişide geçen kelimeler ('kizi' vb.) blok anahtarı sayılmaz
+STATUS_RANK = {"attended": 4, "registered": 3, "waitlist": 2, "no_show": 1, "canceled": 0}
+
+def name_similarity(a: Optional[str], b: Optional[str]) -> float:
+    """Normalize isimlerde difflib oranı; kelime sırası farkı ('Yılmaz Ayşe') için sıralı hali de denenir."""
+    na, nb = normalize_text(a), normalize_text(b)
+    if not na or not nb:
+        return 0.0
+    plain = difflib.SequenceMatcher(None, na, nb).ratio()
+    ordered = difflib.SequenceMatcher(None, " ".join(sorted(na.split())), " ".join(sorted(nb.split()))).ratio()
+    return max(plain, ordered)
+
+def duplicate_score(name_a, phone_a, name_b, phone_b) -> tuple:
+    """(skor, sebep): aynı telefon kesin eşleşme; farklı telefonlar sadece isim birebir aynıysa eşleşir."""
+    pa, pb = normalize_phone(phone_a), normalize_phone(phone_b)
+    if pa and pa == pb:
+        return 1.0, "telefon"
+    score = name_similarity(name_a, name_b)
+    if pa and pb and normalize_text(name_a) != normalize_text(name_b):
+        return 0.0, "farklı telefon"
+    return score, "isim"
+
+def _common_tokens(tokens: Optional[set] = None):
+    """Blok anahtarı sayılmayan sık kelimeler. tokens verilirse yalnız onların sıklığı sayılır
+    (PK (token, person_id) üzerinde aralık okuması); verilmezse tüm tablo gruplanır."""
+    q = select(PersonNameToken.token)
+    if tokens is not None:
+        q = q.where(PersonNameToken.token.in_(tokens))
+    return q.group_by(PersonNameToken.token).having(func.count() > DUP_BLOCK_MAX)
+
+def find_duplicates(s: Session, name: str, phone: Optional[str] = None, exclude_id: Optional[int] = None,
+                    threshold: float = DUP_NAME_THRESHOLD, limit: int = 5) -> list:
+    """Yeni/düzenlenen kayıt için olası mükerrerler: [(Person, skor, sebep)], skora göre azalan.
+
+    Adaylar indeksten gelir (normalize telefon eşitliği + ortak isim kelimesi); tüm tablo taranmaz.
+    """
+    e164 = normalize_phone(phone)
+    tokens = name_tokens(name)
+    ids = set()
+    if e164:
+        ids.update(s.exec(select(Person.id).where(Person.phone_e164 == e164)).all())
+    if tokens:
+        tokens -= set(s.exec(_common_tokens(tokens)).all())
+    if tokens:
+        ids.update(s.exec(
+            select(PersonNameToken.person_id)
+            .where(PersonNameToken.token.in_(tokens))
+            .group_by(PersonNameToken.person_id)
+            .order_by(func.count().desc())
+            .limit(200)
+        ).all())
+    ids.discard(exclude_id)
+    if not ids:
+        return []
+    out = []
+    for p in s.exec(select(Person).where(Person.id.in_(ids))).all():
+        score, reason = duplicate_score(name, phone, p.name, p.phone)
+        if score >= threshold:
+            out.append((p, round(score, 3), reason))
+    out.sort(key=lambda r: -r[1])
+    return out[:limit]
+
+def duplicate_groups(threshold: float = DUP_NAME_THRESHOLD) -> list:
+    """Tüm tablodaki mükerrer grupları: [[person_id, ...], ...] (ilk id = en eski kayıt).
+
+    Aday çiftler blok indeksinden SQL self-join ile üretilir, sadece bu çiftler puanlanır. Bağlı
+    kümeler zincirleme eşleşir (A~B, B~C); bu yüzden her üye grubun ilk kaydına karşı yeniden
+    puanlanır, ona uymayanlar kendi aralarında ayrı gruplanır.
+    """
+    with get_session() as s:
+        a, b = aliased(Person), aliased(Person)
+        pairs = set(s.exec(
+            select(a.id, b.id).join(b, and_(a.phone_e164 == b.phone_e164, a.id < b.id))
+        ).all())
+        t1, t2 = aliased(PersonNameToken), aliased(PersonNameToken)
+        pairs.update(s.exec(
+            select(t1.person_id, t2.person_id).distinct()
+            .join(t2, and_(t1.token == t2.token, t1.person_id < t2.person_id))
+            .where(t1.token.not_in(_common_tokens()))
+        ).all())
+        if not pairs:
+            return []
+        ids = {i for pair in pairs for i in pair}
+        info = {pid: (n, ph) for pid, n, ph in s.exec(select(Person.id, Person.name, Person.phone).where(Person.id.in_(ids))).all()}
+
+    parent = {}
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for x, y in pairs:
+        if duplicate_score(*info[x], *info[y])[0] >= threshold:
+            parent[find(y)] = find(x)
+    clusters = {}
+    for pid in parent:
+        clusters.setdefault(find(pid), []).append(pid)
+    groups = []
+    for rest in clusters.values():
+        rest = sorted(rest)
+        while len(rest) > 1:
+            head, others = rest[0], rest[1:]
+            group = [head] + [o for o in others if duplicate_score(*info[head], *info[o])[0] >= threshold]
+            if len(group) > 1:
+                groups.append(group)
+            rest = [o for o in others if o not in group]
+    return sorted(groups, key=lambda g: g[0])
+
+def is_hard_duplicate(dups: list) -> bool:
+    """Aynı (normalize) telefon kesin mükerrerdir; yalnızca isim benzerliği onayla geçilebilen bir uyarıdır."""
+    return any(reason == "telefon" for _, _, reason in dups)
+
+def merge_persons(s: Session, keep_id: int, dup_ids: list) -> dict:
+    """Mükerrer kişileri keep_id'ye birleştirir (commit çağırana ait).
+
+    Aynı seansta iki kayıt varsa en güçlü durum ('attended' > 'registered' > …) kalır, diğeri ve
+    aynı seansa kesilmiş fazladan borç silinir; kalan kayıtlar, ödemeler, borçlar ve parçalar
+    toplu UPDATE ile taşınır, cüzdan bakiyeleri toplanır.
+    """
+    dup_ids = [d for d in dup_ids if d != keep_id]
+    keep = s.get(Person, keep_id)
+    dups = s.exec(select(Person).where(Person.id.in_(dup_ids))).all()
+    if not keep or not dups:
+        return {"merged": 0, "conflicts": 0}
+    dup_ids = [d.id for d in dups]
+    group = [keep_id] + dup_ids
+
+    # aynı seansta çakışan kayıtlar
+    by_session = {}
+    for e in s.exec(select(Enrollment).where(Enrollment.person_id.in_(group)).order_by(Enrollment.id)).all():
+        by_session.setdefault(e.session_id, []).append(e)
+    conflicts = {sid: rows for sid, rows in by_session.items() if len(rows) > 1}
+    for sid, rows in conflicts.items():
+        winner = max(rows, key=lambda e: (STATUS_RANK.get(e.status, 0), e.person_id == keep_id))
+        for e in rows:
+            if e is not winner:
+                remove_enrollment(s, e)
+        charges = s.exec(
+            select(Charge).where(Charge.session_id == sid, Charge.person_id.in_(group)).order_by(Charge.person_id != keep_id, Charge.id)
+        ).all()
+        for ch in charges[1:]:
+            delete_charge(s, ch)
+    s.flush()
+
+    for model in (Enrollment, Payment, Charge, Piece):
+        s.exec(update(model).where(model.person_id.in_(dup_ids)).values(person_id=keep_id))
+
+    moved = s.exec(select(func.coalesce(func.sum(WalletBalance.balance), 0.0)).where(WalletBalance.person_id.in_(dup_ids))).one()
+    s.exec(delete(WalletBalance).where(WalletBalance.person_id.in_(dup_ids)))
+    if moved:
+        apply_wallet_delta(s, keep_id, float(moved))
+
+    # new_persons rollup'ı: grup tek kişi sayılır, ilk geliş en erken tarih
+    visits = [p.first_visit for p in [keep] + dups if p.first_visit]
+    for p in [keep] + dups:
+        if p.first_visit:
+            bump_daily_kpi(s, p.first_visit, new_persons=-1)
+    first_visit = min(visits) if visits else None
+    if first_visit:
+        bump_daily_kpi(s, first_visit, new_persons=1)
+
+    phone = keep.phone or next((d.phone for d in dups if d.phone), None)
+    instagram = keep.instagram or next((d.instagram for d in dups if d.instagram), None)
+    notes = "\n".join(n for n in [keep.notes] + [d.notes for d in dups] if n) or None
+    is_active = keep.is_active or any(d.is_active for d in dups)
+    for d in dups:
+        s.delete(d)
+    s.flush()  # telefon unique: önce mükerrer satırlar gitmeli
+    keep.phone, keep.instagram, keep.notes = phone, instagram, notes
+    keep.first_visit, keep.is_active = first_visit, is_active
+    s.add(keep)
+    return {"merged": len(dups), "conflicts": len(conflicts)}
+
+def merge_duplicate_groups(groups: list) -> dict:
+    """Toplu mod: kullanıcının tek tek onayladığı grupları en eski kayda (ilk id) birleştirir."""
+    merged = 0
+    with get_session() as s:
+        for g in groups:
+            merged += merge_persons(s, g[0], g[1:])["merged"]
+        s.commit()
+    return {"groups": len(groups), "merged": merged}
+
+# --------- Kişi / kayıt yazımları ---------
+def add_person(s: Session, name: str, phone: Optional[str] = None, instagram: Optional[str] = None,
+               first_visit: Optional[date] = None, notes: Optional[str] = None) -> Person:
+    p = Person(name=name, phone=phone, instagram=instagram, first_visit=first_visit or date.today(), notes=notes)
+    s.add(p)
+    bump_daily_kpi(s, p.first_visit, new_persons=1)
+    return p
+
+def archive_person(s: Session, person_id: int, archived: bool = True):
+    """Soft-delete: kişi listelerden/seçicilerden düşer, defter (ödeme/borç/kayıt) aynen kalır."""
+    s.exec(update(Person).where(Person.id == person_id).values(is_active=not archived))
+
+def delete_person(s: Session, person_id: int) -> dict:
+    """Kişiyi ve bağlı tüm satırları küme-bazlı DELETE'lerle siler (commit çağırana ait).
+
+    Kayıt, ödeme, borç, parça, cüzdan ve isim indeksi tek transaction'da gider; rollup
+    (daily_kpi) ve kasa kapanışları silinen satırlara göre düzeltilir. Arama indeksi
+    (person_fts) veritabanı trigger'ı ile temizlenir.
+    """
+    first_visit = s.exec(select(Person.first_visit).where(Person.id == person_id)).first()
+    if first_visit:
+        bump_daily_kpi(s, first_visit, new_persons=-1)
+    for day, n in s.exec(
+        select(SessionModel.date, func.count(Enrollment.id))
+        .join(SessionModel, SessionModel.id == Enrollment.session_id)
+        .where(Enrollment.person_id == person_id, Enrollment.status == "attended")
+        .group_by(SessionModel.date)
+    ).all():
+        bump_daily_kpi(s, day, attendees=-n)
+    for day, method, total in s.exec(
+        select(Payment.date_, Payment.method, func.sum(Payment.amount))
+        .where(Payment.person_id == person_id, Payment.cleared == True)  # noqa: E712
+        .group_by(Payment.date_, Payment.method)
+    ).all():
+        bump_daily_kpi(s, day, **{("cash_in" if method == "cash" else "iban_in"): -float(total)})
+    first_cash = s.exec(
+        select(func.min(Payment.date_))
+        .where(Payment.person_id == person_id, Payment.method == "cash", Payment.cleared == True)  # noqa: E712
+    ).one()
+    if first_cash:
+        invalidate_cash_closings(s, first_cash)
+    for day, n in s.exec(
+        select(func.date(Piece.delivered_at), func.count(Piece.id))
+        .where(Piece.person_id == person_id, Piece.delivered == True, Piece.delivered_at.is_not(None))  # noqa: E712
+        .group_by(func.date(Piece.delivered_at))
+    ).all():
+        bump_daily_kpi(s, date.fromisoformat(str(day)[:10]), pieces_delivered=-n)
+
+    session_ids = s.exec(select(Enrollment.session_id).where(Enrollment.person_id == person_id).distinct()).all()
+    counts = {}
+    for model in (Enrollment, Payment, Charge, Piece, WalletBalance, PersonNameToken):
+        counts[model.__tablename__] = s.exec(delete(model).where(model.person_id == person_id)).rowcount
+    counts["person"] = s.exec(delete(Person).where(Person.id == person_id)).rowcount
+    if session_ids:
+        refresh_seat_counts(s, session_ids)
+        for sid in session_ids:
+            promote_waitlist(s, sid)
+    return counts
+
+def _session_day(s: Session, session_id: int) -> date:
+    return s.exec(select(SessionModel.date).where(SessionModel.id == session_id)).one()
+
+def lock_session_seats(s: Session, session_id: int) -> Optional[tuple]:
+    """Seans satırını çağıranın transaction'ında kilitler; (kapasite, dolu koltuk, tarih) döner.
+
+    Postgres'te FOR UPDATE; SQLite'ta satıra etkisiz bir UPDATE yazım kilidini commit'e kadar
+    alır (enroll_person'daki BEGIN IMMEDIATE'in oturum içi karşılığı).
+    """
+    q = select(SessionModel.capacity, SessionModel.registered_count + SessionModel.attended_count, SessionModel.date).where(SessionModel.id == session_id)
+    if IS_POSTGRES:
+        q = q.with_for_update()
+    else:
+        s.connection().execute(update(SessionModel).where(SessionModel.id == session_id).values(capacity=SessionModel.capacity))
+    return s.exec(q).first()
+
+def check_seats(s: Session, session_id: int, moving) -> None:
+    """Tekli ve toplu durum değişikliğinin ortak kapasite kontrolü.
+
+    moving filtresine uyan, koltuk tutmayan (waitlist/canceled/no_show) kayıtlar kayıtlı/katıldı
+    durumuna geçecek; seans kilitlendikten sonra sayılır, sığmıyorlarsa ValueError.
+    """
+    capacity, taken, _ = lock_session_seats(s, session_id)
+    needed = s.exec(
+        select(func.count(Enrollment.id))
+        .where(Enrollment.session_id == session_id, moving, Enrollment.status.not_in(ACTIVE_STATUSES))
+    ).one()
+    if needed and taken + needed > capacity:
+        raise ValueError("Kapasite dolu – önce bir koltuk boşaltın.")
+
+def set_enrollment_status(s: Session, e: Enrollment, status: str):
+    """Durumu değiştirir; koltuk tutmayan bir durumdan (waitlist/canceled/no_show) kayıtlı ya da
+    katıldı durumuna geçiş check_seats'ten geçer, seans doluysa ValueError."""
+    old = e.status
+    if old == status:
+        return
+    if status in ACTIVE_STATUSES and old not in ACTIVE_STATUSES:
+        check_seats(s, e.session_id, Enrollment.id == e.id)
+    e.status = status
+    s.add(e)
+    delta = int(status == "attended") - int(old == "attended")
+    if delta:
+        bump_daily_kpi(s, _session_day(s, e.session_id), attendees=delta)
+    if old in ACTIVE_STATUSES and status not in ACTIVE_STATUSES:  # iptal, no_show, waitlist: koltuk boşaldı
+        s.flush()
+        promote_waitlist(s, e.session_id, exclude=e.id)
+
+def remove_enrollment(s: Session, e: Enrollment, promote: bool = True):
+    if e.status == "attended":
+        bump_daily_kpi(s, _session_day(s, e.session_id), attendees=-1)
+    freed = e.status in ACTIVE_STATUSES
+    s.delete(e)
+    if freed and promote:
+        s.flush()
+        promote_waitlist(s, e.session_id)
+
+def promote_waitlist(s: Session, session_id: int, exclude: Optional[int] = None) -> list:
+    """Boşalan koltuklara bekleme listesinden sırayla (id) kişi alır – çağıranın transaction'ında.
+
+    Sıra (session_id, status, id) indeksinden LIMIT'li okunur; geçmiş seanslarda terfi yapılmaz.
+    exclude: koltuğu yeni bırakıp bekleme listesine alınan kayıt (hemen geri terfi etmesin).
+    Terfi eden enrollment id'lerini döner.
+    """
+    row = lock_session_seats(s, session_id)
+    if not row:
+        return []
+    capacity, taken, day = row
+    if day < date.today() or taken >= capacity:
+        return []
+    q = select(Enrollment).where(Enrollment.session_id == session_id, Enrollment.status == "waitlist")
+    if exclude is not None:
+        q = q.where(Enrollment.id != exclude)
+    nxt = s.exec(
+        q.order_by(Enrollment.id)
+        .limit(capacity - taken)
+    ).all()
+    for e in nxt:
+        set_enrollment_status(s, e, "registered")
+    s.flush()
+    return [e.id for e in nxt]
+
+# --------- Tekrarlayan seans serileri ---------
+MAX_SERIES_LEN = 200
+
+def series_dates(start: date, weekdays: list, until: Optional[date] = None, count: Optional[int] = None,
+                 skip: Optional[set] = None) -> list:
+    """Haftalık kural: start'tan itibaren seçili hafta günleri (0=Pazartesi), until'e kadar veya count adet."""
+    if not weekdays or (until is None and not count):
+        return []
+    skip = skip or set()
+    out, d = [], start
+    limit = min(count or MAX_SERIES_LEN, MAX_SERIES_LEN)
+    while len(out) < limit and (until is None or d <= until):
+        if d.weekday() in weekdays and d not in skip:
+            out.append(d)
+        d += timedelta(days=1)
+    return out
+
+def parse_dates(text_: str) -> set:
+    """'24.12.2025, 31.12.2025' → {date, ...}; tanınmayan parçalar yok sayılır."""
+    out = set()
+    for part in re.split(r"[,;\s]+", text_ or ""):
+        for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+            try:
+                out.add(datetime.strptime(part, fmt).date())
+                break
+            except ValueError:
+                continue
+    return out
+
+def session_overlaps(s: Session, dates: list, start_time: dtime, end_time: dtime,
+                     exclude_series: Optional[str] = None) -> list:
+    """Verilen günlerde saat aralığı çakışan seanslar – tek sorgu. [(SessionModel, ders adı)]"""
+    if not dates:
+        return []
+    stmt = (
+        select(SessionModel, Course.name).join(Course)
+        .where(SessionModel.date.in_(dates), SessionModel.start_time < end_time, SessionModel.end_time > start_time)
+        .order_by(SessionModel.date, SessionModel.start_time)
+    )
+    if exclude_series:
+        stmt = stmt.where(or_(SessionModel.series_id.is_(None), SessionModel.series_id != exclude_series))
+    return s.exec(stmt).all()
+
+def create_series(s: Session, course_id: int, dates: list, start_time: dtime, end_time: dtime, capacity: int,
+                  price_override: Optional[float] = None, notes: Optional[str] = None) -> str:
+    """Serinin tüm seanslarını tek toplu INSERT ile yazar; series_id döner (commit çağırana ait)."""
+    series_id = uuid.uuid4().hex
+    if dates:
+        s.exec(insert(SessionModel), params=[{
+            "course_id": course_id, "date": d, "start_time": start_time, "end_time": end_time,
+            "capacity": capacity, "price_override": price_override, "notes": notes, "series_id": series_id,
+        } for d in dates])
+    return series_id
+
+def _series_from(sess: SessionModel):
+    return and_(SessionModel.series_id == sess.series_id, SessionModel.date >= sess.date)
+
+def series_tail_counts(s: Session, sess: SessionModel) -> tuple:
+    """'Bu ve sonrakiler' kapsamındaki (seans, kayıt) sayıları – iptal onayı için."""
+    return s.exec(
+        select(func.count(func.distinct(SessionModel.id)), func.count(Enrollment.id))
+        .select_from(SessionModel)
+        .outerjoin(Enrollment, Enrollment.session_id == SessionModel.id)
+        .where(_series_from(sess))
+    ).one()
+
+def validate_series_update(s: Session, sess: SessionModel, start_time: dtime, end_time: dtime, capacity: int) -> list:
+    """Seri güncellemesi için seri oluşturmadaki kontroller: saat sırası, çakışma, dolu seanslarda kapasite."""
+    if end_time <= start_time:
+        return ["Bitiş saati başlangıçtan sonra olmalı."]
+    errors = []
+    dates = s.exec(select(SessionModel.date).where(_series_from(sess))).all()
+    clashes = session_overlaps(s, dates, start_time, end_time, exclude_series=sess.series_id)
+    if clashes:
+        errors.append("Çakışan seanslar var: " + ", ".join(f"{c.date} {c.start_time.strftime('%H:%M')} {name}" for c, name in clashes))
+    taken = SessionModel.registered_count + SessionModel.attended_count
+    full = s.exec(select(SessionModel.date, taken).where(_series_from(sess), taken > capacity).order_by(SessionModel.date)).all()
+    if full:
+        errors.append(f"Kapasite {capacity} kişiden az olamaz: " + ", ".join(f"{d} ({n} kayıtlı)" for d, n in full))
+    return errors
+
+def update_series_from(s: Session, sess: SessionModel, start_time: dtime, end_time: dtime, capacity: int) -> int:
+    """'Bu ve sonrakiler': serinin bu tarihten sonraki seanslarını tek UPDATE ile değiştirir.
+
+    Kontroller geçmezse ValueError; kapasite artarsa bekleme listeleri sırayla terfi eder.
+    """
+    errors = validate_series_update(s, sess, start_time, end_time, capacity)
+    if errors:
+        raise ValueError("\n".join(errors))
+    n = s.exec(update(SessionModel).where(_series_from(sess))
+               .values(start_time=start_time, end_time=end_time, capacity=capacity)).rowcount
+    for sid in s.exec(
+        select(Enrollment.session_id).distinct()
+        .where(Enrollment.status == "waitlist", Enrollment.session_id.in_(select(SessionModel.id).where(_series_from(sess))))
+    ).all():
+        promote_waitlist(s, sid)
+    return n
+
+def release_session_dependents(s: Session, session_ids) -> dict:
+    """Silinecek seanslara bağlı borçlar iade edilip silinir (cüzdan düzeltilir), parçalar seanssız kalır."""
+    for pid, total in s.exec(
+        select(Charge.person_id, func.sum(Charge.amount)).where(Charge.session_id.in_(session_ids)).group_by(Charge.person_id)
+    ).all():
+        apply_wallet_delta(s, pid, float(total))
+    charges = s.exec(delete(Charge).where(Charge.session_id.in_(session_ids))).rowcount
+    pieces = s.exec(update(Piece).where(Piece.session_id.in_(session_ids)).values(session_id=None)).rowcount
+    return {"charges": charges, "pieces": pieces}
+
+def cancel_series_from(s: Session, sess: SessionModel) -> int:
+    """'Bu ve sonrakiler'i iptal: kayıtlar ve seanslar küme-bazlı DELETE ile silinir, rollup düzeltilir.
+
+    Seanslara kesilmiş borçlar iade edilir, parçaların seans bağlantısı kaldırılır (FK bozulmaz).
+    """
+    ids = select(SessionModel.id).where(_series_from(sess)).scalar_subquery()
+    release_session_dependents(s, ids)
+    for day, n in s.exec(
+        select(SessionModel.date, func.count(Enrollment.id))
+        .join(SessionModel, SessionModel.id == Enrollment.session_id)
+        .where(Enrollment.session_id.in_(ids), Enrollment.status == "attended")
+        .group_by(SessionModel.date)
+    ).all():
+        bump_daily_kpi(s, day, attendees=-n)
+    s.exec(delete(Enrollment).where(Enrollment.session_id.in_(ids)))
+    return s.exec(delete(SessionModel).where(_series_from(sess))).rowcount
+
+# --------- Kayıt servisi (atomik kapasite kontrolü) ---------
+def ensure_indexes() -> bool:
+    """Enrollment (unique kişi+seans, bekleme listesi sırası) ve SessionModel (tarih) indekslerini
+    eski veritabanlarında da kurar.
+
+    Tabloda zaten mükerrer kayıt varsa unique indeks kurulamaz; False döner (enroll_person yine kontrol eder).
+    """
+    ok = True
+    for idx in [*Enrollment.__table__.indexes, *SessionModel.__table__.indexes]:
+        try:
+            with ENGINE.begin() as conn:
+                idx.create(conn, checkfirst=True)
+        except IntegrityError:
+            ok = False
+    return ok
+
+def _sqlite_immediate():
+    """SQLite: AUTOCOMMIT bağlantıda elle BEGIN IMMEDIATE – yazım kilidi okumadan önce alınır."""
+    conn = ENGINE.connect().execution_options(isolation_level="AUTOCOMMIT")
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+    return conn
+
+def enroll_person(person_id: int, session_id: int, price_override: Optional[float] = None,
+                  group_label: Optional[str] = None, waitlist: bool = False) -> tuple:
+    """Kapasite kontrolü + INSERT'i tek atomik işlemde yapar; (enrollment id, durum) döner.
+
+    Postgres'te seans satırı FOR UPDATE ile kilitlenir, SQLite'ta BEGIN IMMEDIATE veritabanı
+    yazım kilidini alır; böylece eşzamanlı iki kayıt aynı boş koltuğu göremez. Aynı kişinin
+    ikinci kaydı unique indeksle de engellenir. Seans doluysa waitlist=True ile kayıt
+    'waitlist' durumunda açılır, aksi halde (ve zaten kayıtlıysa) ValueError.
+    """
+    conn = _sqlite_immediate() if ENGINE.dialect.name == "sqlite" else None
+    try:
+        with Session(bind=conn or ENGINE) as s:
+            sess_q = select(SessionModel.capacity, SessionModel.registered_count + SessionModel.attended_count).where(SessionModel.id == session_id)
+            if conn is None:
+                sess_q = sess_q.with_for_update()
+            row = s.exec(sess_q).first()
+            if row is None:
+                raise ValueError("Seans bulunamadı.")
+            capacity, taken = row
+            if s.exec(select(Enrollment.id).where(Enrollment.person_id == person_id, Enrollment.session_id == session_id)).first():
+                raise ValueError("Bu kişi zaten seansa kayıtlı.")
+            status = "registered"
+            if taken >= capacity:
+                if not waitlist:
+                    raise ValueError("Kapasite dolu – Owner onayı gerekir.")
+                status = "waitlist"
+            e = Enrollment(person_id=person_id, session_id=session_id, status=status,
+                           price_override=price_override, group_label=group_label)
+            s.add(e)
+            s.flush()
+            eid = e.id
+            if conn is not None:
+                conn.exec_driver_sql("COMMIT")
+            s.commit()  # SQLite'ta DB'ye etkisiz; after_commit (veri sürümü) COMMIT'ten sonra tetiklensin
+            return eid, status
+    except IntegrityError:
+        raise ValueError("Bu kişi zaten seansa kayıtlı.")
+    finally:
+        if conn is not None:
+            if conn.connection.dbapi_connection.in_transaction:
+                conn.exec_driver_sql("ROLLBACK")
+            conn.close()
+
+# --------- Seans koltuk sayaçları (registered_count / attended_count) ---------
+SEAT_COUNTERS = {"registered": "registered_count", "attended": "attended_count"}
+
+def seats_taken(sess: SessionModel) -> int:
+    return (sess.registered_count or 0) + (sess.attended_count or 0)
+
+def _bump_seat_counter(connection, session_id: Optional[int], status: Optional[str], delta: int):
+    col = SEAT_COUNTERS.get(status)
+    if col and session_id is not None:
+        connection.execute(
+            update(SessionModel).where(SessionModel.id == session_id)
+            .values({col: getattr(SessionModel, col) + delta})
+        )
+
+# sayaç düzeltmesi eski değere ihtiyaç duyar: expire edilmiş nesnede atamadan önce yüklensin
+def _load_old_value(target, value, oldvalue, initiator):
+    return value
+
+def _seat_count_insert(mapper, connection, target):
+    _bump_seat_counter(connection, target.session_id, target.status, 1)
+
+def _seat_count_delete(mapper, connection, target):
+    _bump_seat_counter(connection, target.session_id, target.status, -1)
+
+def _seat_count_update(mapper, connection, target):
+    state = sa_inspect(target)
+    status_h, session_h = state.attrs.status.history, state.attrs.session_id.history
+    if not (status_h.has_changes() or session_h.has_changes()):
+        return
+    old_status = status_h.deleted[0] if status_h.deleted else target.status
+    old_session = session_h.deleted[0] if session_h.deleted else target.session_id
+    _bump_seat_counter(connection, old_session, old_status, -1)
+    _bump_seat_counter(connection, target.session_id, target.status, 1)
+
+def refresh_seat_counts(s: Session, session_ids=None) -> int:
+    """Sayaçları kayıtlardan tek UPDATE (korelasyonlu alt sorgu) ile yeniden hesaplar.
+
+    ORM dışı toplu UPDATE/DELETE yapan yazımlar etkilenen seanslar için bunu çağırır;
+    session_ids verilmezse tüm seanslar onarılır. Güncellenen seans sayısını döner.
+    """
+    def count(status):
+        return (
+            select(func.count(Enrollment.id))
+            .where(Enrollment.session_id == SessionModel.id, Enrollment.status == status)
+            .scalar_subquery()
+        )
+    stmt = update(SessionModel).values(registered_count=count("registered"), attended_count=count("attended"))
+    if session_ids is not None:
+        stmt = stmt.where(SessionModel.id.in_(session_ids))
+    return s.exec(stmt.execution_options(synchronize_session=False)).rowcount
+
+def seat_count_drift() -> list:
+    """Sayacı kayıtlarla uyuşmayan seanslar: [{session_id, stored, actual}] – mutabakat raporu."""
+    actual = (
+        select(
+            Enrollment.session_id,
+            func.count(Enrollment.id).filter(Enrollment.status == "registered").label("registered"),
+            func.count(Enrollment.id).filter(Enrollment.status == "attended").label("attended"),
+        )
+        .group_by(Enrollment.session_id).subquery()
+    )
+    reg, att = func.coalesce(actual.c.registered, 0), func.coalesce(actual.c.attended, 0)
+    with get_session() as s:
+        rows = s.exec(
+            select(SessionModel.id, SessionModel.registered_count, SessionModel.attended_count, reg, att)
+            .outerjoin(actual, actual.c.session_id == SessionModel.id)
+            .where(or_(SessionModel.registered_count != reg, SessionModel.attended_count != att))
+        ).all()
+    return [{"session_id": sid, "stored": (r0, a0), "actual": (r1, a1)} for sid, r0, a0, r1, a1 in rows]
+
+def cancel_session(s: Session, session_id: int):
+    """Seansı ve tüm kayıtlarını siler (commit çağırana ait); borçlar iade edilir, parçalar seanssız kalır."""
+    release_session_dependents(s, [session_id])
+    for e in s.exec(select(Enrollment).where(Enrollment.session_id == session_id)).all():
+        remove_enrollment(s, e, promote=False)
+    sess = s.get(SessionModel, session_id)
+    if sess:
+        s.delete(sess)
+
+def deliver_piece(s: Session, pc: Piece):
+    pc.delivered = True
+    pc.delivered_at = datetime.now()
+    s.add(pc)
+    bump_daily_kpi(s, pc.delivered_at.date(), pieces_delivered=1)
+
+# --------- Cüzdan defteri (Payment/Charge yazımları + projeksiyon) ---------
+def apply_wallet_delta(s: Session, person_id: int, delta: float):
+    """wallet_balance satırını çağıranın transaction'ı içinde günceller (commit çağırana ait)."""
+    stmt = upsert_insert(WalletBalance).values(person_id=person_id, balance=round(delta, 2), updated_at=datetime.now())
+    s.exec(stmt.on_conflict_do_update(
+        index_elements=[WalletBalance.person_id],
+        set_={"balance": WalletBalance.balance + stmt.excluded.balance, "updated_at": stmt.excluded.updated_at},
+    ))
+
+def record_payment(s: Session, person_id: int, amount: float, method: str, cleared: bool = True,
+                   date_: Optional[date] = None, note: Optional[str] = None) -> Payment:
+    pay = Payment(person_id=person_id, amount=float(amount), method=method, cleared=cleared,
+                  date_=date_ or date.today(), note=note)
+    s.add(pay)
+    if cleared:
+        apply_wallet_delta(s, person_id, float(amount))
+        if method == "cash":
+            invalidate_cash_closings(s, pay.date_)
+        bump_daily_kpi(s, pay.date_, **{("cash_in" if method == "cash" else "iban_in"): float(amount)})
+    return pay
+
+def record_expense(s: Session, amount: float, category: str, paid_from: str = "cash",
+                   date_: Optional[date] = None, note: Optional[str] = None) -> Expense:
+    exp = Expense(amount=float(amount), category=category, paid_from=paid_from,
+                  date_=date_ or date.today(), note=note)
+    s.add(exp)
+    if paid_from == "cash":
+        invalidate_cash_closings(s, exp.date_)
+        bump_daily_kpi(s, exp.date_, expenses=float(amount))  # rollup yalnızca kasadan harcamaları sayar
+    return exp
+
+def record_charge(s: Session, person_id: int, amount: float, session_id: Optional[int] = None,
+                  date_: Optional[date] = None, note: Optional[str] = None) -> Charge:
+    ch = Charge(person_id=person_id, session_id=session_id, amount=float(amount),
+                date_=date_ or date.today(), note=note)
+    s.add(ch)
+    apply_wallet_delta(s, person_id, -float(amount))
+    return ch
+
+def delete_charge(s: Session, charge: Charge):
+    apply_wallet_delta(s, charge.person_id, float(charge.amount))
+    s.delete(charge)
+
 def ensure_charge_for_attendance(eid: int):
     with get_session() as s:
         e = s.get(Enrollment, eid)
@@ -751,58 +2040,593 @@ def ensure_charge_for_attendance(eid: int):
         sess = s.get(SessionModel, e.session_id)
         course = s.get(Course, sess.course_id) if sess else None
         amount = price_for_enrollment(e, sess, course) if (sess and course) else 0.0
-        ch = Charge(
+        record_charge(
+            s,
             person_id=e.person_id,
             session_id=e.session_id,
             amount=amount,
             date_=sess.date if sess else date.today(),
             note="Auto charge: attended",
         )
-        s.add(ch); s.commit()
+        s.commit()
+
+BULK_ATTENDANCE_STATUSES = ACTIVE_STATUSES + ["no_show"]  # yoklamada düzeltilebilen kayıtlar
+
+def bulk_set_attendance(s: Session, session_id: int, enrollment_ids: list, status: str) -> dict:
+    """Seçili kayıtların durumunu tek UPDATE ile değiştirir; 'attended' için eksik borçları
+    tek INSERT ... SELECT ile yazar (commit çağırana ait).
+
+    Yalnızca BULK_ATTENDANCE_STATUSES'taki kayıtlar değişir: iptal ve bekleme listesindekiler
+    yoklamayla 'attended' olamaz (kapasite ve borç atlanırdı). no_show'dan koltuğa dönenler
+    set_enrollment_status ile aynı check_seats kontrolünden geçer; sığmazlarsa ValueError.
+    Borç tutarı price_for_enrollment ile aynı öncelikte SQL'de hesaplanır; cüzdanlar aynı eksik
+    borç sorgusunun kişi başı toplamıyla INSERT'ten önce güncellenir (RETURNING'e gerek yok,
+    SQLite < 3.35'te de çalışır).
+    """
+    if not enrollment_ids:
+        return {"updated": 0, "charged": 0, "skipped": 0}
+    target = and_(Enrollment.session_id == session_id, Enrollment.id.in_(enrollment_ids),
+                  Enrollment.status.in_(BULK_ATTENDANCE_STATUSES))
+    if status in ACTIVE_STATUSES:
+        check_seats(s, session_id, target)
+    eligible = s.exec(select(func.count(Enrollment.id)).where(target)).one()
+    was_attended = s.exec(select(func.count(Enrollment.id)).where(target, Enrollment.status == "attended")).one()
+    updated = s.exec(update(Enrollment).where(target, Enrollment.status != status).values(status=status)).rowcount
+    refresh_seat_counts(s, [session_id])
+    if status not in ACTIVE_STATUSES:
+        promote_waitlist(s, session_id)
+    day = _session_day(s, session_id)
+    if status == "attended":
+        bump_daily_kpi(s, day, attendees=updated)
+    else:
+        bump_daily_kpi(s, day, attendees=-was_attended)
+
+    charged = 0
+    if status == "attended":
+        missing = (
+            select(
+                Enrollment.person_id,
+                Enrollment.session_id,
+                func.coalesce(Enrollment.price_override, SessionModel.price_override, Course.default_price, 0.0).label("amount"),
+                SessionModel.date,
+                literal("Auto charge: attended"),
+            )
+            .join(SessionModel, SessionModel.id == Enrollment.session_id)
+            .join(Course, Course.id == SessionModel.course_id)
+            .where(target, Enrollment.status == "attended")
+            .where(~select(Charge.id).where(Charge.person_id == Enrollment.person_id,
+                                            Charge.session_id == Enrollment.session_id).exists())
+        )
+        m = missing.subquery()
+        per_person = s.exec(
+            select(m.c.person_id, func.sum(m.c.amount), func.count()).group_by(m.c.person_id)
+        ).all()
+        s.exec(insert(Charge).from_select(["person_id", "session_id", "amount", "date_", "note"], missing))
+        for pid, total, n in per_person:
+            apply_wallet_delta(s, pid, -float(total))
+            charged += n
+    return {"updated": updated, "charged": charged, "skipped": len(set(enrollment_ids)) - eligible}
+
+def ledger_wallet_balances(person_id: Optional[int] = None, only_debtors: bool = False) -> dict:
+    """Ham defterden bakiyeler {person_id: bakiye} – tek GROUP BY sorgusu (cleared ödeme − borç).
+
+    Mutabakat için kullanılır; günlük okumalar wallet_balance projeksiyonundan yapılır.
+    """
+    paid = select(Payment.person_id.label("person_id"), Payment.amount.label("amount")).where(Payment.cleared == True)  # noqa: E712
+    charged = select(Charge.person_id.label("person_id"), (-Charge.amount).label("amount"))
+    if person_id is not None:
+        paid = paid.where(Payment.person_id == person_id)
+        charged = charged.where(Charge.person_id == person_id)
+    ledger = union_all(paid, charged).subquery()
+    total = func.sum(ledger.c.amount)
+    q = select(ledger.c.person_id, total).group_by(ledger.c.person_id)
+    if only_debtors:
+        q = q.having(total < 0)
+    with get_session() as s:
+        rows = s.exec(q).all()
+    return {pid: round(bal or 0.0, 2) for pid, bal in rows}
+
+def wallet_balances(person_id: Optional[int] = None, only_debtors: bool = False) -> dict:
+    """Cüzdan bakiyeleri {person_id: bakiye} – wallet_balance projeksiyonundan okunur.
+
+    person_id verilirse sadece o kişi (PK lookup), only_debtors=True ise sadece negatif bakiyeler döner.
+    """
+    q = select(WalletBalance.person_id, WalletBalance.balance)
+    if person_id is not None:
+        q = q.where(WalletBalance.person_id == person_id)
+    if only_debtors:
+        q = q.where(WalletBalance.balance < -0.005)
+    with get_session() as s:
+        rows = s.exec(q).all()
+    return {pid: round(bal or 0.0, 2) for pid, bal in rows}
 
 def wallet_balance(person_id: int) -> float:
+    return wallet_balances(person_id).get(person_id, 0.0)
+
+def reconcile_wallet_balances() -> list:
+    """Projeksiyonu ham defterden toplu olarak yeniden kurar; kayma (drift) listesini döner."""
+    ledger = ledger_wallet_balances()
     with get_session() as s:
-        paid = s.exec(select(Payment.amount).where(Payment.person_id == person_id, Payment.cleared == True)).all()  # noqa: E712
-        charged = s.exec(select(Charge.amount).where(Charge.person_id == person_id)).all()
-        return round(sum(paid or []) - sum(charged or []), 2)
+        stored = dict(s.exec(select(WalletBalance.person_id, WalletBalance.balance)).all())
+        drift = []
+        for pid in sorted(set(ledger) | set(stored)):
+            want, have = ledger.get(pid, 0.0), round(stored.get(pid, 0.0) or 0.0, 2)
+            if abs(want - have) > 0.005:
+                drift.append({"person_id": pid, "stored": have, "ledger": want, "diff": round(have - want, 2)})
+        s.exec(delete(WalletBalance))
+        if ledger:
+            now = datetime.now()
+            s.exec(insert(WalletBalance), params=[
+                {"person_id": pid, "balance": bal, "updated_at": now} for pid, bal in ledger.items()
+            ])
+        s.commit()
+    return drift
 
-def stock_balance(material_id: int) -> float:
+# --------- Stok – sürekli ağırlıklı ortalama maliyet (perpetual WAC) ---------
+# Yön semantiği: 'in' stoğu alış maliyetiyle artırır, 'out' mevcut WAC ile azaltır,
+# 'adjust' işaretli düzeltmedir (sayım farkı: + fazla, − eksik) ve WAC ile değerlenir.
+# Sadece 'in' ortalama maliyeti değiştirir.
+def _apply_movement(qty0: float, avg0: Optional[float], direction: str, qty: float,
+                    unit_cost: Optional[float]) -> tuple:
+    """(yeni_miktar, yeni_wac, hareket_birim_maliyeti) döner."""
+    if direction == "in":
+        c = float(unit_cost or 0.0)
+        new_qty = qty0 + qty
+        if qty0 <= 0 or avg0 is None or new_qty <= 0:
+            new_avg = c
+        else:
+            new_avg = (qty0 * avg0 + qty * c) / new_qty
+        return new_qty, round(new_avg, 4), c
+    delta = -qty if direction == "out" else qty
+    return qty0 + delta, avg0, avg0
+
+def record_stock_movement(material_id: int, direction: str, qty: float,
+                          unit_cost: Optional[float], source: str, session_id: Optional[int] = None,
+                          date_: Optional[date] = None, note: Optional[str] = None) -> int:
+    """Hareketi ekler ve malzemenin miktar/WAC durumunu tek atomik işlemde günceller; hareket id'si döner.
+
+    enroll_person gibi Postgres'te malzeme satırı FOR UPDATE ile, SQLite'ta BEGIN IMMEDIATE ile
+    kilitlenir; eşzamanlı iki hareket aynı on_hand_qty/avg_cost'u okuyup birbirini ezemez.
+    Malzemenin daha ileri tarihli hareketi varsa (geriye tarihli giriş) malzeme aynı işlemde
+    tarih sırasıyla yeniden oynatılır; canlı WAC rebuild_material_costs ile aynı kalır.
+    """
+    date_ = date_ or date.today()
+    conn = _sqlite_immediate() if ENGINE.dialect.name == "sqlite" else None
+    try:
+        with Session(bind=conn or ENGINE) as s:
+            mat_q = select(Material).where(Material.id == material_id)
+            if conn is None:
+                mat_q = mat_q.with_for_update()
+            mat = s.exec(mat_q).one()
+            backdated = s.exec(
+                select(StockMovement.id).where(StockMovement.material_id == material_id, StockMovement.date_ > date_).limit(1)
+            ).first() is not None
+            new_qty, new_avg, basis = _apply_movement(mat.on_hand_qty or 0.0, mat.avg_cost, direction, float(qty), unit_cost)
+            mat.on_hand_qty, mat.avg_cost = round(new_qty, 3), new_avg
+            mv = StockMovement(material_id=material_id, direction=direction, qty=float(qty), unit_cost=unit_cost,
+                               source=source, session_id=session_id, date_=date_, note=note,
+                               cost_basis=basis, avg_cost_after=new_avg)
+            s.add(mat); s.add(mv)
+            s.flush()
+            mv_id = mv.id
+            if backdated:
+                _replay_material_costs(s, [material_id])
+            # Geriye tarihli hareket: o tarihi kapsayan dönem snapshot'ları geçersiz
+            s.exec(delete(InventorySnapshot).where(InventorySnapshot.period_end >= date_))
+            if conn is not None:
+                conn.exec_driver_sql("COMMIT")
+            s.commit()  # SQLite'ta DB'ye etkisiz; after_commit (veri sürümü) COMMIT'ten sonra tetiklensin
+            return mv_id
+    finally:
+        if conn is not None:
+            if conn.connection.dbapi_connection.in_transaction:
+                conn.exec_driver_sql("ROLLBACK")
+            conn.close()
+
+def _replay_material_costs(s: Session, material_ids: Optional[list] = None) -> int:
+    """Hareketleri tarih sırasıyla tek sorguda tekrar oynatıp WAC durumunu çağıranın transaction'ında kurar."""
+    q = select(StockMovement.id, StockMovement.material_id, StockMovement.direction,
+               StockMovement.qty, StockMovement.unit_cost).order_by(StockMovement.date_, StockMovement.id)
+    mq = select(Material.id)
+    if material_ids is not None:
+        q, mq = q.where(StockMovement.material_id.in_(material_ids)), mq.where(Material.id.in_(material_ids))
+    state = {mid: (0.0, None) for mid in s.exec(mq).all()}
+    mv_rows = []
+    for mv_id, mid, direction, qty, unit_cost in s.exec(q).all():
+        qty0, avg0 = state.get(mid, (0.0, None))
+        new_qty, new_avg, basis = _apply_movement(qty0, avg0, direction, qty, unit_cost)
+        state[mid] = (new_qty, new_avg)
+        mv_rows.append({"id": mv_id, "cost_basis": basis, "avg_cost_after": new_avg})
+    if mv_rows:
+        s.exec(update(StockMovement), params=mv_rows)
+    if state:
+        s.exec(update(Material), params=[
+            {"id": mid, "on_hand_qty": round(qty, 3), "avg_cost": avg} for mid, (qty, avg) in state.items()
+        ])
+    return len(mv_rows)
+
+def rebuild_material_costs(material_ids: Optional[list] = None) -> int:
+    """Tüm hareketleri tarih sırasıyla tekrar oynatıp WAC durumunu yeniden kurar."""
     with get_session() as s:
-        ins = s.exec(select(StockMovement.qty).where(StockMovement.material_id == material_id, StockMovement.direction == "in")).all()
-        outs = s.exec(select(StockMovement.qty).where(StockMovement.material_id == material_id, StockMovement.direction == "out")).all()
-        return round(sum(ins or []) - sum(outs or []), 3)
+        n = _replay_material_costs(s, material_ids)
+        # Hareket maliyetleri değişti: dönem snapshot'ları yeniden kurulmalı
+        s.exec(delete(InventorySnapshot))
+        s.commit()
+    return n
+
+def _month_end(d: date) -> date:
+    return date(d.year, d.month, calendar.monthrange(d.year, d.month)[1])
+
+def _signed_stock_qty():
+    """'in' +, 'out' −, 'adjust' işaretli miktar."""
+    return case(
+        (StockMovement.direction == "in", StockMovement.qty),
+        (StockMovement.direction == "out", -StockMovement.qty),
+        (StockMovement.direction == "adjust", StockMovement.qty),
+        else_=0.0,
+    )
+
+def _stock_deltas(s: Session, after: Optional[date], upto: date, group_by_day: bool = False) -> list:
+    """(after, upto] aralığındaki net miktar/değer değişimi – material_id (ve gün) bazında GROUP BY."""
+    signed = _signed_stock_qty()
+    cols = [StockMovement.material_id] + ([StockMovement.date_] if group_by_day else [])
+    q = (
+        select(*cols, func.sum(signed), func.sum(signed * func.coalesce(StockMovement.cost_basis, 0.0)))
+        .where(StockMovement.date_ <= upto)
+        .group_by(*cols)
+    )
+    if after is not None:
+        q = q.where(StockMovement.date_ > after)
+    return s.exec(q).all()
+
+def build_inventory_snapshots(upto: Optional[date] = None) -> int:
+    """Toplu iş: son snapshot'tan itibaren kapanmış her ay sonu için malzeme başı miktar/değer yazar."""
+    last_closed = date.today().replace(day=1) - timedelta(days=1)
+    upto = min(_month_end(upto) if upto else last_closed, last_closed)
+    with get_session() as s:
+        last = s.exec(select(func.max(InventorySnapshot.period_end))).one()
+        if last:
+            state = {mid: (qty, val) for mid, qty, val in s.exec(
+                select(InventorySnapshot.material_id, InventorySnapshot.qty, InventorySnapshot.value)
+                .where(InventorySnapshot.period_end == last)
+            ).all()}
+            period = _month_end(last + timedelta(days=1))
+        else:
+            first = s.exec(select(func.min(StockMovement.date_))).one()
+            if not first:
+                return 0
+            state, period = {}, _month_end(first)
+        if period > upto:
+            return 0
+        by_month = {}
+        for mid, day, dq, dv in _stock_deltas(s, last, upto, group_by_day=True):
+            acc = by_month.setdefault(_month_end(day), {})
+            q0, v0 = acc.get(mid, (0.0, 0.0))
+            acc[mid] = (q0 + (dq or 0.0), v0 + (dv or 0.0))
+        rows, now = [], datetime.now()
+        while period <= upto:
+            for mid, (dq, dv) in by_month.get(period, {}).items():
+                q0, v0 = state.get(mid, (0.0, 0.0))
+                state[mid] = (q0 + dq, v0 + dv)
+            rows.extend({"material_id": mid, "period_end": period, "qty": round(qty, 3), "value": round(val, 2),
+                         "created_at": now} for mid, (qty, val) in state.items())
+            period = _month_end(period + timedelta(days=1))
+        if rows:
+            s.exec(insert(InventorySnapshot), params=rows)
+        s.commit()
+    return len(rows)
+
+def stock_as_of(day: date, material_ids: Optional[list] = None) -> dict:
+    """Gün sonu stok: en yakın önceki snapshot + sonrasındaki hareketler.
+
+    Dönüş: {material_id: {"balance", "value", "wac"}}
+    """
+    with get_session() as s:
+        period = s.exec(select(func.max(InventorySnapshot.period_end)).where(InventorySnapshot.period_end <= day)).one()
+        state = {}
+        if period:
+            state = {mid: [qty, val] for mid, qty, val in s.exec(
+                select(InventorySnapshot.material_id, InventorySnapshot.qty, InventorySnapshot.value)
+                .where(InventorySnapshot.period_end == period)
+            ).all()}
+        for mid, dq, dv in _stock_deltas(s, period, day):
+            acc = state.setdefault(mid, [0.0, 0.0])
+            acc[0] += dq or 0.0
+            acc[1] += dv or 0.0
+    out = {}
+    for mid, (qty, val) in state.items():
+        if material_ids is not None and mid not in material_ids:
+            continue
+        qty, val = round(qty, 3), round(val, 2)
+        out[mid] = {"balance": qty, "value": val, "wac": (round(val / qty, 4) if qty > 0 else None)}
+    return out
+
+def stock_summary(material_ids: Optional[list] = None) -> dict:
+    """Malzeme başı stok/WAC/değer – Material üzerindeki sürekli WAC durumundan okunur.
+
+    Dönüş: {material_id: {"balance", "wac", "value"}}
+    """
+    q = select(Material.id, Material.on_hand_qty, Material.avg_cost)
+    if material_ids is not None:
+        q = q.where(Material.id.in_(material_ids))
+    with get_session() as s:
+        rows = s.exec(q).all()
+    out = {}
+    for mid, bal, wac in rows:
+        bal = round(bal or 0.0, 3)
+        out[mid] = {"balance": bal, "wac": wac, "value": (None if wac is None else round(bal * wac, 2))}
+    return out
+
+def stock_balance(material_id: int) -> float:
+    return stock_summary([material_id]).get(material_id, {}).get("balance", 0.0)
 
 def wac_cost(material_id: int) -> Optional[float]:
+    return stock_summary([material_id]).get(material_id, {}).get("wac")
+
+# --------- Kasa (nakit) – günlük kapanış checkpoint'leri ---------
+def invalidate_cash_closings(s: Session, day: date):
+    """Geriye tarihli nakit hareketi: o gün ve sonrasındaki kapanışlar geçersiz."""
+    s.exec(delete(CashClosing).where(CashClosing.date_ >= day))
+
+def _cash_delta(s: Session, after: Optional[date], upto: Optional[date]) -> float:
+    """(after, upto] aralığındaki net nakit: nakit tahsilat − kasadan harcama (tek sorgu)."""
+    cin = select(func.coalesce(func.sum(Payment.amount), 0.0)).where(Payment.method == "cash", Payment.cleared == True)  # noqa: E712
+    cout = select(func.coalesce(func.sum(Expense.amount), 0.0)).where(Expense.paid_from == "cash")
+    if after is not None:
+        cin, cout = cin.where(Payment.date_ > after), cout.where(Expense.date_ > after)
+    if upto is not None:
+        cin, cout = cin.where(Payment.date_ <= upto), cout.where(Expense.date_ <= upto)
+    return float(s.exec(select(cin.scalar_subquery() - cout.scalar_subquery())).one() or 0.0)
+
+def _last_cash_closing(s: Session, as_of: Optional[date] = None) -> Optional[CashClosing]:
+    q = select(CashClosing).order_by(CashClosing.date_.desc()).limit(1)
+    if as_of is not None:
+        q = q.where(CashClosing.date_ <= as_of)
+    return s.exec(q).first()
+
+def cash_on_hand(as_of: Optional[date] = None) -> float:
+    """Kasadaki net nakit: son kapanış (yoksa açılış) + sonrasındaki nakit hareketleri.
+
+    as_of verilirse o günün sonundaki kasa (denetim için) hesaplanır.
+    """
     with get_session() as s:
-        rows = s.exec(select(StockMovement.qty, StockMovement.unit_cost).where(StockMovement.material_id == material_id, StockMovement.direction == "in")).all()
-        total_qty = sum(q for q, _ in rows)
-        if total_qty <= 0:
-            return None
-        total_val = sum((q * (c or 0)) for q, c in rows)
-        return round(total_val / total_qty, 4)
+        cp = _last_cash_closing(s, as_of)
+        base = cp.closing_balance if cp else OPENING_CASH
+        return round(base + _cash_delta(s, cp.date_ if cp else None, as_of), 2)
+
+def close_cash_days(upto: Optional[date] = None) -> int:
+    """Son kapanıştan upto'ya (en geç dün) kadar her gün için kasa kapanışı yazar; yazılan gün sayısını döner."""
+    yesterday = date.today() - timedelta(days=1)
+    upto = min(upto or yesterday, yesterday)
+    with get_session() as s:
+        cp = _last_cash_closing(s)
+        if cp:
+            start, balance = cp.date_ + timedelta(days=1), cp.closing_balance
+        else:
+            first = s.exec(select(func.min(Payment.date_)).where(Payment.method == "cash")).one()
+            first_exp = s.exec(select(func.min(Expense.date_)).where(Expense.paid_from == "cash")).one()
+            firsts = [d for d in (first, first_exp) if d]
+            if not firsts:
+                return 0
+            start, balance = min(firsts), OPENING_CASH
+        if start > upto:
+            return 0
+        cin = dict(s.exec(
+            select(Payment.date_, func.sum(Payment.amount))
+            .where(Payment.method == "cash", Payment.cleared == True, Payment.date_ >= start, Payment.date_ <= upto)  # noqa: E712
+            .group_by(Payment.date_)
+        ).all())
+        cout = dict(s.exec(
+            select(Expense.date_, func.sum(Expense.amount))
+            .where(Expense.paid_from == "cash", Expense.date_ >= start, Expense.date_ <= upto)
+            .group_by(Expense.date_)
+        ).all())
+        rows, now, day = [], datetime.now(), start
+        while day <= upto:
+            balance = round(balance + (cin.get(day) or 0.0) - (cout.get(day) or 0.0), 2)
+            rows.append({"date_": day, "closing_balance": balance, "created_at": now})
+            day += timedelta(days=1)
+        s.exec(insert(CashClosing), params=rows)
+        s.commit()
+    return len(rows)
+
+@st.cache_resource
+def auto_close_cash(today: date) -> int:
+    """Günde bir kez (process başına) dünkü kasa kapanışını yazar."""
+    return close_cash_days(today - timedelta(days=1))
 
-def cash_on_hand() -> float:
-    """Kasadaki net nakit: açılış + nakit tahsilat − kasadan harcama."""
+# --------- Dashboard KPI'ları (tek SQL, cache'li) ---------
+@st.cache_data(ttl=KPI_CACHE_TTL, show_spinner=False)
+def dashboard_kpis(today: date, version: int) -> dict:
+    """Tüm dashboard KPI'larını tek SQL ifadesiyle hesaplar.
+
+    version=data_version(): uygulamanın yazımları cache'i geçersiz kılar.
+    """
+    cp_date = select(func.max(CashClosing.date_)).scalar_subquery()
+    cp_balance = select(CashClosing.closing_balance).where(CashClosing.date_ == cp_date).scalar_subquery()
+    is_cash = Payment.method == "cash"
+    pay = (
+        select(
+            func.sum(Payment.amount).filter(Payment.date_ == today, is_cash).label("cash_today"),
+            func.sum(Payment.amount).filter(Payment.date_ == today, Payment.method == "iban").label("iban_today"),
+            func.sum(Payment.amount).filter(is_cash, or_(cp_date.is_(None), Payment.date_ > cp_date)).label("cash_since"),
+        )
+        .where(Payment.cleared == True)  # noqa: E712
+        .subquery()
+    )
+    exp = (
+        select(
+            func.sum(Expense.amount).filter(Expense.date_ == today).label("out_today"),
+            func.sum(Expense.amount).filter(or_(cp_date.is_(None), Expense.date_ > cp_date)).label("out_since"),
+        )
+        .where(Expense.paid_from == "cash")
+        .subquery()
+    )
+    att = (
+        select(func.count(func.distinct(Enrollment.person_id)).label("attended"))
+        .select_from(Enrollment).join(SessionModel, SessionModel.id == Enrollment.session_id)
+        .where(SessionModel.date == today, Enrollment.status == "attended")
+        .subquery()
+    )
+    pcs = select(func.count(Piece.id).label("undelivered")).where(Piece.delivered == False).subquery()  # noqa: E712
+    stmt = select(
+        pay.c.cash_today, pay.c.iban_today, pay.c.cash_since,
+        exp.c.out_today, exp.c.out_since, att.c.attended, pcs.c.undelivered, cp_balance,
+    ).select_from(pay.join(exp, true()).join(att, true()).join(pcs, true()))
+    with get_session() as s:
+        cash_today, iban_today, cash_since, out_today, out_since, attended, undelivered, base = s.exec(stmt).one()
+    base = OPENING_CASH if base is None else base
+    return {
+        "kasa": round(base + (cash_since or 0.0) - (out_since or 0.0), 2),
+        "nakit_bugun": (cash_today or 0.0) - (out_today or 0.0),
+        "iban_bugun": iban_today or 0.0,
+        "katilan": attended or 0,
+        "teslim_bekleyen": undelivered or 0,
+    }
+
+def upcoming_sessions(today: date) -> list:
+    """En yakın seans gününün seansları + katılımcıları – tek sorgu (seans ⋈ ders ⟕ kayıt ⟕ kişi)."""
+    next_day = select(func.min(SessionModel.date)).where(SessionModel.date >= today).scalar_subquery()
+    stmt = (
+        select(SessionModel, Course.name, Person.name, Person.phone)
+        .join(Course, Course.id == SessionModel.course_id)
+        .outerjoin(Enrollment, and_(Enrollment.session_id == SessionModel.id,
+                                    Enrollment.status.in_(["registered", "attended"])))
+        .outerjoin(Person, Person.id == Enrollment.person_id)
+        .where(SessionModel.date == next_day)
+        .order_by(SessionModel.start_time, SessionModel.id, Person.name)
+    )
     with get_session() as s:
-        cash_in = s.exec(select(Payment.amount).where(Payment.method == "cash", Payment.cleared == True)).all()  # noqa: E712
-        cash_out = s.exec(select(Expense.amount).where(Expense.paid_from == "cash")).all()
-        return round(OPENING_CASH + sum(cash_in or []) - sum(cash_out or []), 2)
+        rows = s.exec(stmt).all()
+    by_session = {}
+    for sess, course_name, p_name, p_phone in rows:
+        row = by_session.setdefault(sess.id, {
+            "course": course_name, "date": sess.date, "start": sess.start_time, "end": sess.end_time,
+            "capacity": sess.capacity, "taken": seats_taken(sess), "participants": [],
+        })
+        if p_name is not None:
+            row["participants"].append(f"{p_name} ({p_phone or '-'})")
+    return list(by_session.values())
+
+def session_roster(s: Session, d1: date, d2: date) -> tuple:
+    """Tarih aralığındaki seanslar ve katılımcıları – iki sorgu, seans başına sorgu yok.
+
+    (items, participants) döner: items = [(SessionModel, Course)], participants = {session_id: [(Enrollment, Person)]}.
+    Doluluk seans sayaçlarından okunur (seats_taken).
+    """
+    items = s.exec(
+        select(SessionModel, Course).join(Course)
+        .where(SessionModel.date >= d1, SessionModel.date <= d2)
+        .order_by(SessionModel.date, SessionModel.start_time)
+    ).all()
+    participants = {}
+    for e, p in s.exec(
+        select(Enrollment, Person)
+        .join(Person, Person.id == Enrollment.person_id)
+        .join(SessionModel, SessionModel.id == Enrollment.session_id)
+        .where(SessionModel.date >= d1, SessionModel.date <= d2)
+        .order_by(Enrollment.session_id, Person.name)
+    ).all():
+        participants.setdefault(e.session_id, []).append((e, p))
+    return items, participants
+
+# hafta/ajanda görünümü komşu pencereleri de önceden yüklediği için görünüm başına ~3 giriş
+@st.cache_data(ttl=VERSIONED_CACHE_TTL, max_entries=4 * VERSIONED_CACHE_MAX, show_spinner=False)
+def calendar_range_index(first_day: date, last_day: date, version: int) -> dict:
+    """Takvim indeksi (first_day..last_day dahil) – {"sessions": {gün: [seans dict]}, "notes": {gün: not}}.
+
+    Üç sorgu (seans ⋈ ders, kayıt ⋈ kişi, notlar), seans tarihi ix_sessionmodel_date_start ile
+    aralık taramasıdır; pencere + veri sürümüyle cache'lenir, kullanıcılar arasında paylaşılır.
+    Dönen yapı ORM nesnesi içermez.
+    """
+    in_range = and_(SessionModel.date >= first_day, SessionModel.date <= last_day)
+    sessions, by_id = {}, {}
+    with get_session() as s:
+        for sess, course in s.exec(
+            select(SessionModel, Course).join(Course, Course.id == SessionModel.course_id)
+            .where(in_range).order_by(SessionModel.date, SessionModel.start_time)
+        ).all():
+            item = {
+                "id": sess.id, "date": sess.date, "start": sess.start_time, "end": sess.end_time,
+                "course": course.name, "capacity": sess.capacity, "taken": seats_taken(sess),
+                "price": sess.price_override if sess.price_override else course.default_price,
+                "notes": sess.notes, "participants": [],
+            }
+            sessions.setdefault(sess.date, []).append(item)
+            by_id[sess.id] = item
+        for e, p in s.exec(
+            select(Enrollment, Person)
+            .join(Person, Person.id == Enrollment.person_id)
+            .join(SessionModel, SessionModel.id == Enrollment.session_id)
+            .where(in_range).order_by(Enrollment.session_id, Enrollment.id)
+        ).all():
+            by_id[e.session_id]["participants"].append({
+                "enrollment_id": e.id, "status": e.status, "group_label": e.group_label, "note": e.note,
+                "name": p.name, "phone": p.phone, "person_notes": p.notes,
+            })
+        notes = dict(s.exec(
+            select(DailyNote.date_, DailyNote.note).where(DailyNote.date_ >= first_day, DailyNote.date_ <= last_day)
+        ).all())
+    return {"sessions": sessions, "notes": notes}
+
+def calendar_month_index(year: int, month: int, version: int) -> dict:
+    return calendar_range_index(date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1]), version)
+
+def week_start(d: date) -> date:
+    return d - timedelta(days=d.weekday())
+
+@st.cache_data(ttl=VERSIONED_CACHE_TTL, max_entries=VERSIONED_CACHE_MAX, show_spinner=False)
+def calendar_years(version: int) -> list:
+    """Yıl seçicisi: ilk seanstan son seansa (bu yıl ve sonraki yıl her zaman dahil)."""
+    this_year = date.today().year
+    with get_session() as s:
+        lo, hi = s.exec(select(func.min(SessionModel.date), func.max(SessionModel.date))).one()
+    return list(range(min(lo.year if lo else this_year, this_year), max(hi.year if hi else this_year, this_year + 1) + 1))
+
+# --------- ORM olay dinleyicileri (süreç başına bir kez) ---------
+@st.cache_resource
+def register_events():
+    """ORM olay dinleyicilerini süreç başına bir kez bağlar.
+
+    Streamlit betiği her etkileşimde yeniden çalıştırır; dinleyiciler modül seviyesinde
+    bağlansaydı cache'li sınıflara her seferinde yeni bir kopya eklenir, olaylar katlanırdı.
+    """
+    event.listen(Session, "after_flush", _mark_session_wrote)
+    event.listen(Session, "do_orm_execute", _mark_session_dml)
+    event.listen(Session, "after_commit", _bump_on_commit)
+    event.listen(Session, "after_rollback", _clear_on_rollback)
+    event.listen(Person, "before_insert", _person_search_key)
+    event.listen(Person, "before_update", _person_search_key)
+    event.listen(Person, "after_insert", _person_name_tokens)
+    event.listen(Person, "after_update", _person_name_tokens)
+    event.listen(Person, "before_delete", _person_name_tokens_delete)
+    for attr in (Enrollment.status, Enrollment.session_id):
+        event.listen(attr, "set", _load_old_value, active_history=True)
+    event.listen(Enrollment, "after_insert", _seat_count_insert)
+    event.listen(Enrollment, "after_delete", _seat_count_delete)
+    event.listen(Enrollment, "after_update", _seat_count_update)
+
+register_events()
 
 # ============================ UI PAGES ============================
 def page_dashboard():
     today = date.today()
-    with get_session() as s:
-        cash_today_in  = s.exec(select(Payment.amount).where(Payment.date_ == today, Payment.cleared == True, Payment.method == "cash")).all()  # noqa: E712
-        iban_today_in  = s.exec(select(Payment.amount).where(Payment.date_ == today, Payment.cleared == True, Payment.method == "iban")).all()  # noqa: E712
-        cash_today_out = s.exec(select(Expense.amount).where(Expense.date_ == today, Expense.paid_from == "cash")).all()
-        attended_today = s.exec(select(Enrollment).join(SessionModel).where(SessionModel.date == today, Enrollment.status == "attended")).all()
-        undelivered    = s.exec(select(Piece).where(Piece.delivered == False)).all()  # noqa: E712
-
-    kasa            = cash_on_hand()
-    nakit_bugun     = sum(cash_today_in or []) - sum(cash_today_out or [])
-    iban_bugun      = sum(iban_today_in or [])
-    katilan         = len(set(e.person_id for e in attended_today))
-    teslim_bekleyen = len(undelivered)
+    kpis = dashboard_kpis(today, data_version())
+
+    kasa            = kpis["kasa"]
+    nakit_bugun     = kpis["nakit_bugun"]
+    iban_bugun      = kpis["iban_bugun"]
+    katilan         = kpis["katilan"]
+    teslim_bekleyen = kpis["teslim_bekleyen"]
+
+    # Trendler: daily_kpi rollup'ından bugün vs dün
+    tr = kpi_trends(today, data_version())
+    t0, t1 = tr["today"], tr["yesterday"]
+    trend_kasa   = _trend_badge(kasa, kasa - nakit_bugun)
+    trend_nakit  = _trend_badge(t0["cash_in"] - t0["expenses"], t1["cash_in"] - t1["expenses"])
+    trend_iban   = _trend_badge(t0["iban_in"], t1["iban_in"])
+    trend_katil  = _trend_badge(katilan, t1["unique_attendees"], "kişi")
+    trend_teslim = _trend_badge(t0["pieces_delivered"], t1["pieces_delivered"], "parça")
 
     # Revolutionary KPI Cards with animations
     st.markdown(
@@ -818,7 +2642,7 @@ def page_dashboard():
             </div>
             <div class="kpi-hint">
               <span>Açılış + tahsilat − harcama</span>
-              <div class="kpi-trend up">↗ +12.5%</div>
+              {trend_kasa}
             </div>
           </div>
           
@@ -832,7 +2656,7 @@ def page_dashboard():
             </div>
             <div class="kpi-hint">
               <span>Giren − çıkan</span>
-              <div class="kpi-trend up">↗ +8.2%</div>
+              {trend_nakit}
             </div>
           </div>
           
@@ -846,7 +2670,7 @@ def page_dashboard():
             </div>
             <div class="kpi-hint">
               <span>Cleared ödemeler</span>
-              <div class="kpi-trend up">↗ +15.1%</div>
+              {trend_iban}
             </div>
           </div>
           
@@ -860,7 +2684,7 @@ def page_dashboard():
             </div>
             <div class="kpi-hint">
               <span>Bugün unique kişi</span>
-              <div class="kpi-trend up">↗ +5 kişi</div>
+              {trend_katil}
             </div>
           </div>
           
@@ -873,8 +2697,8 @@ def page_dashboard():
               </div>
             </div>
             <div class="kpi-hint">
-              <span>Parça sayısı</span>
-              <div class="kpi-trend down">↘ -3 parça</div>
+              <span>Bugün teslim: {t0["pieces_delivered"]}</span>
+              {trend_teslim}
             </div>
           </div>
         </div>
@@ -886,58 +2710,46 @@ def page_dashboard():
     col_left, col_right = st.columns([1,1])
 
     with col_left:
+        sessions = upcoming_sessions(today)
+        if sessions:
+            items_html = "".join(
+                f"""
+                  <div class="session-item">
+                    <div class="session-header">
+                      <div class="session-info">
+                        <h4>{escape(row['course'])}</h4>
+                        <p>{row['date']} • {row['start'].strftime('%H:%M')}-{row['end'].strftime('%H:%M')}</p>
+                      </div>
+                      <div class="session-badge">{row['taken']}/{row['capacity']}</div>
+                    </div>
+                    <div class="participants">
+                      Katılımcılar: {', '.join(escape(n) for n in row['participants']) if row['participants'] else '—'}
+                    </div>
+                  </div>"""
+                for row in sessions
+            )
+        else:
+            items_html = """
+                  <div class="empty-state">
+                    <div class="empty-state-icon">📅</div>
+                    <p>Yaklaşan seans bulunmuyor</p>
+                  </div>"""
+        # Tüm panel tek HTML bloğu olarak basılır (seans sayısından bağımsız tek st.markdown)
         st.markdown(
-            """
+            f"""
             <div class="content-card">
               <div class="card-header">
                 <div class="card-title">📅 Yarın / En Yakın Seanslar</div>
                 <div class="card-subtitle">İsim & telefon görünür</div>
               </div>
               <div class="card-content">
-                <div class="session-list">
+                <div class="session-list">{items_html}
+                </div>
+              </div>
+            </div>
             """,
             unsafe_allow_html=True,
         )
-        with get_session() as s:
-            nd = s.exec(select(SessionModel.date).where(SessionModel.date >= today).order_by(SessionModel.date).limit(1)).first()
-            if nd:
-                sessions = s.exec(select(SessionModel, Course).join(Course).where(SessionModel.date == nd).order_by(SessionModel.start_time)).all()
-            else:
-                sessions = []
-            
-            if sessions:
-                for sess, course in sessions:
-                    atts = s.exec(select(Enrollment, Person).join(Person).where(Enrollment.session_id == sess.id, Enrollment.status.in_(["registered", "attended"]))).all()
-                    names = [f"{p.name} ({p.phone or '-'})" for _,p in atts]
-                    st.markdown(
-                        f"""
-                        <div class="session-item">
-                          <div class="session-header">
-                            <div class="session-info">
-                              <h4>{course.name}</h4>
-                              <p>{sess.date} • {sess.start_time.strftime('%H:%M')}-{sess.end_time.strftime('%H:%M')}</p>
-                            </div>
-                            <div class="session-badge">{len(atts)}/{sess.capacity}</div>
-                          </div>
-                          <div class="participants">
-                            Katılımcılar: {', '.join(names) if names else '—'}
-                          </div>
-                        </div>
-                        """,
-                        unsafe_allow_html=True,
-                    )
-            else:
-                st.markdown(
-                    """
-                    <div class="empty-state">
-                      <div class="empty-state-icon">📅</div>
-                      <p>Yaklaşan seans bulunmuyor</p>
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
-        
-        st.markdown("</div></div></div>", unsafe_allow_html=True)
 
     with col_right:
         st.markdown(
@@ -951,13 +2763,10 @@ def page_dashboard():
             """,
             unsafe_allow_html=True,
         )
+        balances = wallet_balances(only_debtors=True)
         with get_session() as s:
-            people = s.exec(select(Person).where(Person.is_active == True)).all()  # noqa: E712
-        debtors = []
-        for p in people:
-            bal = wallet_balance(p.id)
-            if bal < 0:
-                debtors.append({"name": p.name, "phone": p.phone, "bal": bal})
+            people = s.exec(select(Person).where(Person.is_active == True, Person.id.in_(list(balances)))).all() if balances else []  # noqa: E712
+        debtors = [{"name": p.name, "phone": p.phone, "bal": balances[p.id]} for p in people]
         
         if debtors:
             for r in sorted(debtors, key=lambda x: x["bal"]):
@@ -991,13 +2800,10 @@ def page_dashboard():
 
 def page_people():
     st.header("👤 Kişiler")
+    balances = wallet_balances(only_debtors=True)
     with get_session() as s:
-        people = s.exec(select(Person).where(Person.is_active == True)).all()  # noqa: E712
-    rows = []
-    for p in people:
-        bal = wallet_balance(p.id)
-        if bal < 0:
-            rows.append({"Kişi": p.name, "Telefon": p.phone, "Bakiye": bal})
+        people = s.exec(select(Person).where(Person.is_active == True, Person.id.in_(list(balances)))).all() if balances else []  # noqa: E712
+    rows = [{"Kişi": p.name, "Telefon": p.phone, "Bakiye": balances[p.id]} for p in people]
     if rows:
         for r in sorted(rows, key=lambda x: x["Bakiye"]):
             st.markdown(
@@ -1025,107 +2831,145 @@ def page_people():
                 ig = st.text_input("Instagram (ops)")
                 first = st.date_input("İlk Geliş", value=date.today())
                 notes = st.text_area("Not")
+                force = st.checkbox("Benzer isim olsa da kaydet", help="Yalnızca isim benzerliği uyarısını geçer; aynı telefon yine engellenir.")
                 ok = st.form_submit_button("Kaydet")
             if ok and name.strip():
-                # Duplicate check - case insensitive
-                existing = s.exec(
-                    select(Person).where(
-                        (func.lower(Person.name) == func.lower(name.strip())) | 
-                        (Person.phone == phone.strip() if phone.strip() else False)
-                    )
-                ).first()
-                
-                if existing:
-                    st.warning(f"Bu kişi zaten kayıtlı: {existing.name} ({existing.phone or 'Telefon yok'})")
+                dups = find_duplicates(s, name.strip(), phone.strip() or None)
+                if dups and (is_hard_duplicate(dups) or not force):
+                    st.warning("Bu kişi zaten kayıtlı olabilir: " + ", ".join(
+                        f"{p.name} ({p.phone or 'Telefon yok'}, %{score * 100:.0f} {reason})" for p, score, reason in dups
+                    ))
+                    if not is_hard_duplicate(dups):
+                        st.caption("Farklı bir kişiyse 'Benzer isim olsa da kaydet' kutusunu işaretleyip tekrar kaydedin.")
                 else:
-                    s.add(Person(name=name.strip(), phone=(phone.strip() or None), instagram=(ig.strip() or None), first_visit=first, notes=(notes or None)))
+                    add_person(s, name.strip(), phone=(phone.strip() or None), instagram=(ig.strip() or None), first_visit=first, notes=(notes or None))
                     s.commit(); st.success("Kişi eklendi")
-        q = st.text_input("Ara (isim/tel)")
-        people = s.exec(select(Person).order_by(Person.name)).all()
-        filtered_people = [p for p in people if (not q or (q.lower() in (p.name or '').lower() or (q in (p.phone or ''))))]
-        
-        if filtered_people:
-            st.write(f"**{len(filtered_people)} kişi bulundu:**")
-            
-            # Show people with delete buttons
-            for person in filtered_people:
-                col1, col2, col3, col4, col5, col6 = st.columns([3, 2, 2, 2, 1, 1])
-                
-                with col1:
-                    st.write(f"**{person.name}**")
-                with col2:
-                    st.write(person.phone or "-")
-                with col3:
-                    st.write(person.instagram or "-")
-                with col4:
-                    st.write(str(person.first_visit) if person.first_visit else "-")
-                with col5:
-                    if st.button("✏️", key=f"edit_{person.id}", help="Düzenle"):
-                        st.session_state[f"edit_person_{person.id}"] = True
-                with col6:
-                    if st.button("🗑️", key=f"delete_{person.id}", help="Sil", type="secondary"):
-                        st.session_state[f"confirm_delete_{person.id}"] = True
-                
-                # Edit form
-                if st.session_state.get(f"edit_person_{person.id}"):
-                    with st.form(f"edit_form_{person.id}"):
-                        new_name = st.text_input("Ad Soyad", value=person.name)
-                        new_phone = st.text_input("Telefon", value=person.phone or "")
-                        new_ig = st.text_input("Instagram", value=person.instagram or "")
-                        new_notes = st.text_area("Not", value=person.notes or "")
-                        
-                        col_save, col_cancel = st.columns(2)
-                        with col_save:
-                            save_edit = st.form_submit_button("💾 Kaydet", type="primary")
-                        with col_cancel:
-                            cancel_edit = st.form_submit_button("❌ İptal")
-                        
-                        if save_edit and new_name.strip():
-                            person.name = new_name.strip()
-                            person.phone = new_phone.strip() or None
-                            person.instagram = new_ig.strip() or None
-                            person.notes = new_notes.strip() or None
-                            s.commit()
-                            st.success("Kişi güncellendi!")
-                            del st.session_state[f"edit_person_{person.id}"]
-                            st.rerun()
-                        elif cancel_edit:
-                            del st.session_state[f"edit_person_{person.id}"]
-                            st.rerun()
-                
-                # Delete confirmation
-                if st.session_state.get(f"confirm_delete_{person.id}"):
-                    st.error(f"**{person.name}** kişisini silmek istediğinizden emin misiniz?")
-                    st.write("⚠️ Bu işlem geri alınamaz. Kişinin tüm seans kayıtları ve ödemeleri de silinecek.")
-                    
-                    col_yes, col_no = st.columns(2)
-                    with col_yes:
-                        if st.button("✅ Evet, Sil", key=f"confirm_yes_{person.id}", type="primary"):
-                            # Delete related records first
-                            enrollments = s.exec(select(Enrollment).where(Enrollment.person_id == person.id)).all()
-                            for enrollment in enrollments:
-                                s.delete(enrollment)
-                            
-                            payments = s.exec(select(Payment).where(Payment.person_id == person.id)).all()
-                            for payment in payments:
-                                s.delete(payment)
-                            
-                            # Delete the person
-                            s.delete(person)
+        with st.expander("🧬 Mükerrer Kayıtlar", expanded=False):
+            st.caption("Normalize telefon ve benzer isimlerle olası mükerrer kişileri bulur; onaylanan gruplar en eski kayda birleştirilir.")
+            if st.button("🔍 Mükerrerleri Tara"):
+                st.session_state["dup_groups"] = duplicate_groups()
+            groups = st.session_state.get("dup_groups")
+            if groups is not None:
+                if not groups:
+                    st.success("Mükerrer kayıt bulunmadı.")
+                else:
+                    info = {pid: (n, ph) for pid, n, ph in s.exec(
+                        select(Person.id, Person.name, Person.phone).where(Person.id.in_({i for g in groups for i in g}))
+                    ).all()}
+                    st.write(f"**{len(groups)} grup bulundu** (skorlar grubun ilk kaydına göre):")
+                    confirmed = []
+                    for g in groups:
+                        if not all(i in info for i in g):
+                            continue
+                        gc1, gc2, gc3 = st.columns([5, 1, 1])
+                        parts = []
+                        for i in g[1:]:
+                            score, reason = duplicate_score(*info[g[0]], *info[i])
+                            parts.append(f"{info[i][0]} (#{i}, %{score * 100:.0f} {reason})")
+                        gc1.write(f"{info[g[0]][0]} (#{g[0]}) ↔ " + ", ".join(parts))
+                        if gc2.checkbox("Onayla", key=f"merge_ok_{g[0]}"):
+                            confirmed.append(g)
+                        if gc3.button("Birleştir", key=f"merge_{g[0]}"):
+                            res = merge_persons(s, g[0], g[1:])
                             s.commit()
-                            
-                            st.success(f"{person.name} başarıyla silindi!")
-                            del st.session_state[f"confirm_delete_{person.id}"]
+                            st.session_state["dup_groups"] = [x for x in groups if x != g]
+                            st.success(f"{res['merged']} kayıt birleştirildi ({res['conflicts']} seans çakışması çözüldü).")
                             st.rerun()
-                    
-                    with col_no:
-                        if st.button("❌ Hayır, İptal", key=f"confirm_no_{person.id}"):
-                            del st.session_state[f"confirm_delete_{person.id}"]
-                            st.rerun()
-                
-                st.divider()
+                    if st.button(f"⚡ Onaylananları Birleştir ({len(confirmed)})", type="primary", disabled=not confirmed):
+                        res = merge_duplicate_groups(confirmed)
+                        st.session_state["dup_groups"] = [x for x in groups if x not in confirmed]
+                        st.success(f"{res['groups']} grupta {res['merged']} kayıt birleştirildi.")
+                        st.rerun()
+
+        c1, c2, c3 = st.columns([4, 1, 1])
+        q = c1.text_input("Ara (isim/tel)")
+        page_size = c2.selectbox("Sayfa boyutu", PAGE_SIZES, index=1)
+        show_archived = c3.checkbox("Arşivdekiler", help="Arşivlenmiş kişileri de göster")
+        nav = st.session_state.setdefault("people_nav", {"key": None, "cursors": [None]})
+        if nav["key"] != (q, page_size, show_archived):  # arama/sayfa boyutu değişti: ilk sayfaya dön
+            nav.update(key=(q, page_size, show_archived), cursors=[None])
+
+        if q.strip():
+            people = search_people(q, limit=page_size, active_only=not show_archived)
+            has_next = False
+            st.caption(f"{len(people)} sonuç" + (" (ilk sonuçlar — aramayı daraltın)" if len(people) == page_size else ""))
         else:
+            people, has_next = people_page(s, nav["cursors"][-1], page_size, active_only=not show_archived)
+            total = people_count(not show_archived, data_version())
+            page_no = len(nav["cursors"])
+            st.caption(f"Toplam {total} kişi · Sayfa {page_no}/{max(1, -(-total // page_size))}")
+            b1, b2, _ = st.columns([1, 1, 6])
+            if b1.button("◀ Önceki", disabled=page_no == 1):
+                nav["cursors"].pop(); st.rerun()
+            if b2.button("Sonraki ▶", disabled=not has_next):
+                nav["cursors"].append((people[-1].name, people[-1].id)); st.rerun()
+
+        if not people:
             st.info("Kişi bulunamadı.")
+            return
+
+        df = pd.DataFrame([{
+            "ID": p.id, "Ad Soyad": p.name, "Telefon": p.phone or "-", "Instagram": p.instagram or "-",
+            "İlk Geliş": p.first_visit, "Aktif": p.is_active,
+        } for p in people])
+        event_ = st.dataframe(
+            df, hide_index=True, use_container_width=True, on_select="rerun", selection_mode="single-row",
+            column_config={"ID": None}, key=f"people_grid_{len(nav['cursors'])}_{q}",
+        )
+        rows = event_.selection.rows if event_ else []
+        if not rows:
+            st.caption("Düzenlemek veya silmek için tablodan bir satır seçin.")
+            return
+
+        person = s.get(Person, int(df.iloc[rows[0]]["ID"]))
+        if not person:
+            st.rerun()
+        st.subheader(f"✏️ {person.name}")
+        with st.form(f"edit_form_{person.id}"):
+            new_name = st.text_input("Ad Soyad", value=person.name)
+            new_phone = st.text_input("Telefon", value=person.phone or "")
+            new_ig = st.text_input("Instagram", value=person.instagram or "")
+            new_notes = st.text_area("Not", value=person.notes or "")
+            save_edit = st.form_submit_button("💾 Kaydet", type="primary")
+        if save_edit and new_name.strip():
+            person.name = new_name.strip()
+            person.phone = new_phone.strip() or None
+            person.instagram = new_ig.strip() or None
+            person.notes = new_notes.strip() or None
+            s.commit()
+            st.success("Kişi güncellendi!")
+            st.rerun()
+
+        confirm_key = f"confirm_delete_{person.id}"
+        if not st.session_state.get(confirm_key):
+            col_arc, col_del, _ = st.columns([1, 1, 4])
+            if person.is_active and col_arc.button("🗄️ Arşivle", help="Listelerden gizle, ödeme/borç geçmişi korunur"):
+                archive_person(s, person.id)
+                s.commit(); st.rerun()
+            if not person.is_active and col_arc.button("♻️ Arşivden Çıkar"):
+                archive_person(s, person.id, archived=False)
+                s.commit(); st.rerun()
+            if col_del.button("🗑️ Sil", type="secondary"):
+                st.session_state[confirm_key] = True
+                st.rerun()
+            return
+        st.error(f"**{person.name}** kişisini silmek istediğinizden emin misiniz?")
+        st.write("⚠️ Bu işlem geri alınamaz. Kişinin tüm seans kayıtları, ödemeleri, borçları ve parçaları da silinecek. "
+                 "Geçmişi korumak için **Arşivle**'yi kullanın.")
+        col_yes, col_no = st.columns(2)
+        with col_yes:
+            if st.button("✅ Evet, Sil", key=f"confirm_yes_{person.id}", type="primary"):
+                name = person.name
+                delete_person(s, person.id)
+                s.commit()
+
+                del st.session_state[confirm_key]
+                st.success(f"{name} başarıyla silindi!")
+                st.rerun()
+        with col_no:
+            if st.button("❌ Hayır, İptal", key=f"confirm_no_{person.id}"):
+                del st.session_state[confirm_key]
+                st.rerun()
 
 def page_courses_sessions():
     st.header("📚 Dersler & Seanslar")
@@ -1158,18 +3002,69 @@ def page_courses_sessions():
                 s.add(SessionModel(course_id=course_sel.id, date=sdate, start_time=stime, end_time=etime, capacity=int(cap), price_override=pov, notes=notes or None))
                 s.commit(); st.success("Seans eklendi")
 
+        with st.expander("🔁 Tekrarlayan Seri Oluştur", expanded=False):
+            with st.form("series_form"):
+                r_course = st.selectbox("Ders", options=courses, format_func=lambda c: f"{c.name} (₺{c.default_price:,.0f})", key="series_course")
+                r_days = st.multiselect("Günler", options=list(range(7)), default=[1, 3], format_func=lambda i: WEEKDAYS_TR[i])
+                rc1, rc2 = st.columns(2)
+                r_start = rc1.date_input("İlk Tarih", value=date.today(), key="series_start")
+                r_stime = rc1.time_input("Başlangıç", value=dtime(10, 0), key="series_stime")
+                r_etime = rc2.time_input("Bitiş", value=dtime(12, 0), key="series_etime")
+                r_cap = rc2.number_input("Kapasite", 1, 50, value=DEFAULT_CAPACITY, key="series_cap")
+                r_end = st.radio("Bitiş kuralı", ["Bitiş tarihi", "Seans sayısı"], horizontal=True)
+                rc3, rc4 = st.columns(2)
+                r_until = rc3.date_input("Bitiş Tarihi", value=date.today() + timedelta(days=90), key="series_until")
+                r_count = rc4.number_input("Seans Sayısı", 1, MAX_SERIES_LEN, value=12, key="series_count")
+                r_skip = st.text_input("Atlanacak tarihler (GG.AA.YYYY, virgülle)", key="series_skip")
+                r_price = st.number_input("Seans Özel Fiyat (TL) – opsiyonel", 0.0, 100000.0, value=0.0, step=50.0, key="series_price")
+                r_notes = st.text_input("Not (ops)", key="series_notes")
+                r_skip_conflicts = st.checkbox("Çakışan günleri atla", value=True)
+                ok3 = st.form_submit_button("Seriyi Oluştur")
+            if ok3 and r_course:
+                dates = series_dates(
+                    r_start, r_days,
+                    until=r_until if r_end == "Bitiş tarihi" else None,
+                    count=int(r_count) if r_end == "Seans sayısı" else None,
+                    skip=parse_dates(r_skip),
+                )
+                # üst sınıra takıldıysa kuralın devamı var mı: varsa kullanıcıya söylenir
+                capped = dates[-1] if len(dates) == MAX_SERIES_LEN and r_end == "Bitiş tarihi" and series_dates(
+                    dates[-1] + timedelta(days=1), r_days, until=r_until, count=1, skip=parse_dates(r_skip)) else None
+                clashes = session_overlaps(s, dates, r_stime, r_etime)
+                if r_etime <= r_stime:
+                    st.error("Bitiş saati başlangıçtan sonra olmalı.")
+                elif not dates:
+                    st.warning("Kurala uyan tarih yok.")
+                elif clashes and not r_skip_conflicts:
+                    st.error("Çakışan seanslar var: " + ", ".join(f"{c.date} {c.start_time.strftime('%H:%M')} {name}" for c, name in clashes))
+                else:
+                    clash_days = {c.date for c, _ in clashes}
+                    dates = [d for d in dates if d not in clash_days]
+                    pov = None if r_price <= 0 else float(r_price)
+                    create_series(s, r_course.id, dates, r_stime, r_etime, int(r_cap), pov, r_notes or None)
+                    s.commit()
+                    st.success(f"{len(dates)} seans oluşturuldu" + (f" ({len(clash_days)} çakışan gün atlandı)" if clash_days else ""))
+                    if capped:
+                        st.warning(f"Bir seri en fazla {MAX_SERIES_LEN} seans olabilir; {capped} sonrasındaki tarihler oluşturulmadı.")
+
         st.subheader("Seans Listesi")
         d1 = st.date_input("Başlangıç", value=date.today() - timedelta(days=30), key="sess_d1")
         d2 = st.date_input("Bitiş", value=date.today() + timedelta(days=14), key="sess_d2")
-        items = s.exec(select(SessionModel, Course).join(Course).where(SessionModel.date >= d1, SessionModel.date <= d2).order_by(SessionModel.date, SessionModel.start_time)).all()
+        items, participants = session_roster(s, d1, d2)
+        # kişi seçici tek sefer yüklenir, tüm seanslarda paylaşılır
+        ppl = {pid: f"{name} ({phone or '-'})" for pid, name, phone in s.exec(
+            select(Person.id, Person.name, Person.phone).where(Person.is_active == True).order_by(Person.name)  # noqa: E712
+        ).all()}
         for sess, course in items:
-            regs = s.exec(select(Enrollment).where(Enrollment.session_id == sess.id, Enrollment.status.in_(["registered", "attended"]))).all()
+            regs_full = participants.get(sess.id, [])
+            active = seats_taken(sess)
+            waiting = sum(1 for e, _ in regs_full if e.status == "waitlist")
             st.markdown(
                 f"""
                 <div class="item" style="margin-bottom:8px;">
                   <div class="row">
                     <div><b>🗓 {sess.date} {sess.start_time.strftime('%H:%M')}–{sess.end_time.strftime('%H:%M')}</b> | {course.name}</div>
-                    <div class="badge">{len(regs)}/{sess.capacity}</div>
+                    <div class="badge">{active}/{sess.capacity}{f" (+{waiting} ⏳)" if waiting else ""}</div>
                   </div>
                   <div class="soft">Fiyat: ₺{(sess.price_override if sess.price_override else course.default_price):,.0f}</div>
                 </div>
@@ -1177,32 +3072,48 @@ def page_courses_sessions():
                 unsafe_allow_html=True,
             )
             with st.expander("Katılımcılar / İşlemler", expanded=False):
-                ppl = s.exec(select(Person).order_by(Person.name)).all()
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    p_sel = st.selectbox(f"Kişi Seç (sess#{sess.id})", options=ppl, key=f"p{sess.id}", format_func=lambda p: f"{p.name} ({p.phone or '-'})")
+                    p_sel = st.selectbox(f"Kişi Seç (sess#{sess.id})", options=list(ppl), key=f"p{sess.id}", format_func=ppl.get)
                 with col2:
                     price_override = st.number_input("Kayıt özel fiyat (ops)", 0.0, 100000.0, 0.0, step=50.0, key=f"po{sess.id}")
                 with col3:
                     grp = st.text_input("Grup Etiketi (ops)", key=f"grp{sess.id}")
-                add_btn = st.button("Kayıt Ekle", key=f"add{sess.id}")
+                cb1, cb2 = st.columns([1, 3])
+                add_btn = cb1.button("Kayıt Ekle", key=f"add{sess.id}")
+                use_waitlist = cb2.checkbox("Doluysa bekleme listesine al", value=True, key=f"wl{sess.id}")
                 if add_btn and p_sel:
-                    if len(regs) >= sess.capacity:
-                        st.error("Kapasite dolu – Owner onayı gerekir.")
+                    pov = None if price_override <= 0 else float(price_override)
+                    try:
+                        _, status = enroll_person(p_sel, sess.id, price_override=pov, group_label=grp or None, waitlist=use_waitlist)
+                    except ValueError as exc:
+                        st.error(str(exc))
                     else:
-                        exist = s.exec(select(Enrollment).where(Enrollment.person_id == p_sel.id, Enrollment.session_id == sess.id)).first()
-                        if exist:
-                            st.warning("Bu kişi zaten seansa kayıtlı.")
-                        else:
-                            pov = None if price_override <= 0 else float(price_override)
-                            s.add(Enrollment(person_id=p_sel.id, session_id=sess.id, price_override=pov, group_label=grp or None))
-                            s.commit(); st.success("Kayıt eklendi")
-                            regs.append("_marker_")
+                        st.success("Kayıt eklendi" if status == "registered" else "Kapasite dolu – bekleme listesine alındı ⏳")
+                        st.rerun()
                 rows = []
-                regs_full = s.exec(select(Enrollment, Person).join(Person).where(Enrollment.session_id == sess.id).order_by(Person.name)).all()
                 for e, p in regs_full:
                     rows.append({"EnrollID": e.id, "Ad": p.name, "Tel": p.phone, "Durum": e.status, "Özel Fiyat": e.price_override or "-", "Grup": e.group_label or "-"})
                 st.dataframe(pd.DataFrame(rows), use_container_width=True)
+                if regs_full:
+                    st.markdown("**⚡ Toplu Yoklama**")
+                    names = {e.id: p.name for e, p in regs_full if e.status in BULK_ATTENDANCE_STATUSES}
+                    bc1, bc2, bc3 = st.columns([3, 1, 1])
+                    chosen = bc1.multiselect(
+                        "Kişiler", options=list(names), key=f"bulk_sel{sess.id}", format_func=names.get,
+                        default=[e.id for e, _ in regs_full if e.status == "registered"],
+                    )
+                    bulk_status = bc2.selectbox("Durum", ["attended", "no_show", "canceled"], key=f"bulk_st{sess.id}")
+                    if bc3.button("Uygula", key=f"bulk_go{sess.id}", type="primary") and chosen:
+                        try:
+                            res = bulk_set_attendance(s, sess.id, chosen, bulk_status)
+                        except ValueError as exc:
+                            s.rollback()
+                            st.error(str(exc))
+                        else:
+                            s.commit()
+                            st.success(f"{res['updated']} kayıt güncellendi, {res['charged']} borç oluşturuldu")
+                            st.rerun()
                 for e, p in regs_full:
                     colA, colB, colC = st.columns([2, 1, 1])
                     with colA:
@@ -1211,10 +3122,48 @@ def page_courses_sessions():
                         new_status = st.selectbox("Durum", STATUS_CHOICES, index=STATUS_CHOICES.index(e.status), key=f"stat{e.id}")
                     with colC:
                         if st.button("Kaydet", key=f"save{e.id}"):
-                            e.status = new_status
-                            s.add(e); s.commit()
-                            ensure_charge_for_attendance(e.id)
-                            st.success("Güncellendi")
+                            try:
+                                set_enrollment_status(s, e, new_status)
+                            except ValueError as exc:
+                                s.rollback()
+                                st.error(str(exc))
+                            else:
+                                s.commit()
+                                ensure_charge_for_attendance(e.id)
+                                st.success("Güncellendi")
+                if sess.series_id:
+                    st.markdown("**🔁 Seri: bu ve sonraki seanslar**")
+                    with st.form(f"series_edit_{sess.id}"):
+                        sc1, sc2, sc3 = st.columns(3)
+                        n_stime = sc1.time_input("Başlangıç", value=sess.start_time)
+                        n_etime = sc2.time_input("Bitiş", value=sess.end_time)
+                        n_cap = sc3.number_input("Kapasite", 1, 50, value=sess.capacity)
+                        save_series = st.form_submit_button("💾 Bu ve Sonrakileri Güncelle")
+                    if save_series:
+                        try:
+                            n = update_series_from(s, sess, n_stime, n_etime, int(n_cap))
+                        except ValueError as exc:
+                            st.error(str(exc))
+                        else:
+                            s.commit(); st.success(f"{n} seans güncellendi")
+                            st.rerun()
+                    confirm_key = f"confirm_series_cancel_{sess.id}"
+                    if st.button("🗑️ Bu ve Sonrakileri İptal Et", key=f"series_cancel_{sess.id}"):
+                        st.session_state[confirm_key] = True
+                    if st.session_state.get(confirm_key):
+                        n_sess, n_enr = series_tail_counts(s, sess)
+                        st.error(f"**{sess.date} ve sonrasındaki {n_sess} seansı iptal etmek istediğinizden emin misiniz?**")
+                        st.write(f"⚠️ Bu işlem geri alınamaz. {n_enr} kayıt silinecek, bu seanslara kesilmiş borçlar iade edilecek.")
+                        cy, cn = st.columns(2)
+                        if cy.button("✅ Evet, İptal Et", key=f"series_cancel_yes_{sess.id}", type="primary"):
+                            n = cancel_series_from(s, sess)
+                            s.commit()
+                            del st.session_state[confirm_key]
+                            st.success(f"{n} seans iptal edildi")
+                            st.rerun()
+                        if cn.button("❌ Hayır, İptal Etme", key=f"series_cancel_no_{sess.id}"):
+                            del st.session_state[confirm_key]
+                            st.rerun()
 
 def page_notes():
     st.header("📝 Günlük Notlar")
@@ -1379,7 +3328,7 @@ def page_payments():
                 ok = st.form_submit_button("Tahsil Et")
             if ok and p_sel and amt > 0:
                 with get_session() as s2:
-                    s2.add(Payment(person_id=p_sel.id, amount=float(amt), method=method, cleared=True, note=note or None))
+                    record_payment(s2, p_sel.id, float(amt), method, note=note or None)
                     s2.commit()
                 st.success("Ödeme kaydedildi")
         st.caption(f"Kasadaki nakit (anlık): **₺{cash_on_hand():,.0f}**")
@@ -1395,7 +3344,7 @@ def page_payments():
                 ok2 = st.form_submit_button("Harcamayı Kaydet (Kasadan)")
             if ok2 and e_amt > 0:
                 with get_session() as s2:
-                    s2.add(Expense(amount=float(e_amt), category=e_cat, paid_from="cash", date_=e_date, note=e_note or None))
+                    record_expense(s2, float(e_amt), e_cat, paid_from="cash", date_=e_date, note=e_note or None)
                     s2.commit()
                 st.success("Harcama kaydedildi")
         st.caption(f"Kasadaki nakit (anlık): **₺{cash_on_hand():,.0f}**")
@@ -1418,16 +3367,42 @@ def page_payments():
         df_in = pd.DataFrame([{"Tarih": p.date_, "Tür": "Nakit Tahsilat", "Tutar": p.amount, "Not": p.note} for p in cash_in] +
                              [{"Tarih": p.date_, "Tür": "IBAN Tahsilat", "Tutar": p.amount, "Not": p.note} for p in iban_in])
         df_out = pd.DataFrame([{"Tarih": e.date_, "Tür": f"Harcama/{e.category}", "Tutar": -e.amount, "Not": e.note} for e in cash_out])
-        df = pd.concat([df_in, df_out], ignore_index=True).sort_values("Tarih")
-        st.dataframe(df, use_container_width=True)
+        df = pd.concat([df_in, df_out], ignore_index=True)
+        st.dataframe(df.sort_values("Tarih") if not df.empty else df, use_container_width=True)
+
+        st.markdown("**Kasa Kapanışları**")
+        col_a, col_b = st.columns(2)
+        with col_a:
+            audit_day = st.date_input("Tarihteki kasa (gün sonu)", value=date.today() - timedelta(days=1), key="kasa_asof")
+            st.metric(f"Kasa – {audit_day}", f"₺{cash_on_hand(audit_day):,.0f}")
+        with col_b:
+            st.caption("Dünden geriye eksik gün sonu kapanışlarını yazar. Geriye tarihli kayıtlar ilgili kapanışları siler.")
+            if st.button("📒 Kasa Kapanışı Yap", key="kasa_close"):
+                n = close_cash_days()
+                st.success(f"{n} gün kapatıldı.")
+        with get_session() as s:
+            closings = s.exec(select(CashClosing).where(CashClosing.date_ >= d1, CashClosing.date_ <= d2).order_by(CashClosing.date_)).all()
+        if closings:
+            st.dataframe(pd.DataFrame([{"Tarih": c.date_, "Kapanış": c.closing_balance} for c in closings]), use_container_width=True)
 
     # Cüzdan bakiyeleri
     st.subheader("Cüzdan Bakiyeleri")
     with get_session() as s:
         ppl2 = s.exec(select(Person).order_by(Person.name)).all()
-    rows = [{"Kişi": p.name, "Telefon": p.phone, "Bakiye": wallet_balance(p.id)} for p in ppl2]
+    balances = wallet_balances()
+    rows = [{"Kişi": p.name, "Telefon": p.phone, "Bakiye": balances.get(p.id, 0.0)} for p in ppl2]
     st.dataframe(pd.DataFrame(rows).sort_values("Bakiye"), use_container_width=True)
 
+    with st.expander("🔄 Bakiye Mutabakatı", expanded=False):
+        st.caption("Cüzdan projeksiyonunu ham ödeme/borç kayıtlarından yeniden kurar ve farkları listeler.")
+        if st.button("Mutabakatı Çalıştır", key="wallet_reconcile"):
+            drift = reconcile_wallet_balances()
+            if drift:
+                st.warning(f"{len(drift)} kişide fark bulundu ve düzeltildi.")
+                st.dataframe(pd.DataFrame(drift), use_container_width=True)
+            else:
+                st.success("Fark yok – projeksiyon defterle uyumlu.")
+
 def page_pieces():
     st.header("🏺 Parça / Aşama Takibi")
     with get_session() as s:
@@ -1462,9 +3437,7 @@ def page_pieces():
                 st.rerun()
             if deliver_btn:
                 # Aynı session içinde güncelle
-                pc.delivered = True
-                pc.delivered_at = datetime.now()
-                s.add(pc)
+                deliver_piece(s, pc)
                 s.commit()
                 st.success("Teslim edildi")
                 st.rerun()
@@ -1488,134 +3461,362 @@ def page_stock():
                     s.add(Material(name=name.strip(), category=cat, default_unit=unit, brand=brand or None, color_code=code or None))
                     s.commit(); st.success("Malzeme eklendi")
         mats = s.exec(select(Material).where(Material.is_active == True).order_by(Material.name)).all()  # noqa: E712
+        summary = stock_summary([m.id for m in mats]) if mats else {}
         with st.form("move_add"):
-            m_sel = st.selectbox("Malzeme", options=mats, format_func=lambda m: f"{m.name} ({m.default_unit}) – Stok: {stock_balance(m.id)}")
+            m_sel = st.selectbox("Malzeme", options=mats, format_func=lambda m: f"{m.name} ({m.default_unit}) – Stok: {summary.get(m.id, {}).get('balance', 0.0)}")
             direction = st.selectbox("Yön", ["in", "out", "adjust"], index=0)
-            qty = st.number_input("Miktar", 0.0, 1e9, 0.0, step=0.1)
+            qty = st.number_input("Miktar ('adjust' için +/− fark)", -1e9, 1e9, 0.0, step=0.1)
             unit_cost = st.number_input("Birim Maliyet (sadece 'in')", 0.0, 1e9, 0.0, step=0.1)
             source = st.selectbox("Kaynak", ["purchase", "consumption", "waste", "test", "adjust"], index=0)
             note = st.text_input("Not (ops)")
             okm = st.form_submit_button("Hareket Kaydet")
-        if okm and m_sel and qty > 0:
+        if okm and m_sel and qty != 0:
             uc = unit_cost if direction == "in" else None
-            if direction == "in" and (uc is None or uc <= 0):
+            if direction != "adjust" and qty < 0:
+                st.error("Negatif miktar sadece 'adjust' için kullanılabilir")
+            elif direction == "in" and (uc is None or uc <= 0):
                 st.error("'in' için birim maliyet zorunlu")
             else:
-                with get_session() as s2:
-                    s2.add(StockMovement(material_id=m_sel.id, direction=direction, qty=float(qty), unit_cost=uc, source=source, note=note or None))
-                    s2.commit(); st.success("Hareket kaydedildi")
+                record_stock_movement(m_sel.id, direction, float(qty), uc, source, note=note or None)
+                st.success("Hareket kaydedildi")
         st.subheader("Anlık Stok + WAC + Değer")
+        if okm:
+            summary = stock_summary([m.id for m in mats])
         rows = []
         for m in mats:
-            bal = stock_balance(m.id)
-            wac = wac_cost(m.id)
-            rows.append({"Malzeme": m.name, "Birim": m.default_unit, "Stok": bal, "WAC": wac, "Tahmini Değer": (None if (wac is None) else round(bal * (wac or 0), 2))})
-        st.dataframe(pd.DataFrame(rows).sort_values("Malzeme"), use_container_width=True)
+            agg = summary.get(m.id, {})
+            rows.append({"Malzeme": m.name, "Birim": m.default_unit, "Stok": agg.get("balance", 0.0), "WAC": agg.get("wac"), "Tahmini Değer": agg.get("value")})
+        if rows:
+            st.dataframe(pd.DataFrame(rows), use_container_width=True)
+        else:
+            st.info("Henüz malzeme yok.")
+
+        st.subheader("Ay Sonu Envanter")
+        month_ends = [_month_end(date.today().replace(day=1) - timedelta(days=1))]
+        for _ in range(23):
+            month_ends.append(month_ends[-1].replace(day=1) - timedelta(days=1))
+        col_m, col_b = st.columns([3, 1])
+        with col_m:
+            period = st.selectbox("Ay sonu", month_ends, format_func=lambda d: f"{d.strftime('%d.%m.%Y')} ({MONTHS_TR[d.month]} {d.year})")
+        with col_b:
+            if st.button("📸 Snapshot Oluştur", key="inv_snapshot", help="Kapanmış ayların envanter snapshot'larını yazar"):
+                st.success(f"{build_inventory_snapshots()} satır yazıldı")
+        as_of = stock_as_of(period, [m.id for m in mats])
+        month_rows = [{"Malzeme": m.name, "Birim": m.default_unit, "Stok": as_of[m.id]["balance"],
+                       "WAC": as_of[m.id]["wac"], "Değer": as_of[m.id]["value"]} for m in mats if m.id in as_of]
+        if month_rows:
+            st.dataframe(pd.DataFrame(month_rows), use_container_width=True)
+        else:
+            st.info("Bu tarihte stok hareketi yok.")
+
+        st.subheader("Son Hareketler (hareket anı maliyeti)")
+        moves = s.exec(
+            select(StockMovement, Material).join(Material)
+            .order_by(StockMovement.date_.desc(), StockMovement.id.desc()).limit(50)
+        ).all()
+        if moves:
+            st.dataframe(pd.DataFrame([{
+                "Tarih": mv.date_, "Malzeme": mat.name, "Yön": mv.direction, "Miktar": mv.qty, "Kaynak": mv.source,
+                "Birim Maliyet": mv.cost_basis, "Tutar": (None if mv.cost_basis is None else round(mv.qty * mv.cost_basis, 2)),
+                "WAC (sonra)": mv.avg_cost_after,
+            } for mv, mat in moves]), use_container_width=True)
 
 def page_reports():
     st.header("📈 Raporlar")
+    d1 = st.date_input("Başlangıç", value=date.today())
+    d2 = st.date_input("Bitiş", value=date.today())
+    totals = daily_kpi_totals(d1, d2)
+
+    st.metric("Nakit Toplam", f"₺{totals['cash_in']:,.0f}")
+    st.metric("IBAN Toplam", f"₺{totals['iban_in']:,.0f}")
+    st.metric("Harcama (Kasadan)", f"₺{totals['expenses']:,.0f}")
+    st.metric("Katılım (seans-kişi)", f"{totals['attendees']}")
+    st.metric("Yeni Kişi", f"{totals['new_persons']}")
+    st.metric("Teslim Edilen Parça", f"{totals['pieces_delivered']}")
+    if st.button("🔄 Rollup'ı Yeniden Kur", help="daily_kpi tablosunu işlem kayıtlarından baştan hesaplar"):
+        st.success(f"{backfill_daily_kpi()} gün yeniden hesaplandı")
+
+    st.subheader("Dönem Kırılımı")
+    bucket = st.radio("Kırılım", list(REPORT_BUCKETS), format_func=REPORT_BUCKETS.get, horizontal=True, index=2 if (d2 - d1).days > 62 else 0)
+    frames = report_frames(d1, d2, bucket)
+    tab_pay, tab_exp, tab_course = st.tabs(["Tahsilat", "Harcama", "Dersler"])
+    with tab_pay:
+        pv = _pivot(frames["payments"], "Yöntem", "Tutar")
+        if pv.empty:
+            st.info("Bu aralıkta tahsilat yok.")
+        else:
+            st.bar_chart(pv.drop(columns="Toplam"))
+            st.dataframe(pv, use_container_width=True)
+    with tab_exp:
+        pv = _pivot(frames["expenses"], "Kategori", "Tutar")
+        if pv.empty:
+            st.info("Bu aralıkta harcama yok.")
+        else:
+            st.bar_chart(pv.drop(columns="Toplam"))
+            st.dataframe(pv, use_container_width=True)
+    with tab_course:
+        df = frames["courses"]
+        if df.empty:
+            st.info("Bu aralıkta seans yok.")
+        else:
+            st.line_chart(_pivot(df, "Ders", "Katılım").drop(columns="Toplam"))
+            by_course = df.groupby("Ders")[["Seans", "Katılım", "Gelir"]].sum()
+            by_course["Katılım/Seans"] = (by_course["Katılım"] / by_course["Seans"]).round(1)
+            st.dataframe(by_course, use_container_width=True)
+            st.dataframe(_pivot(df, "Ders", "Gelir"), use_container_width=True)
+
+    st.subheader("Doluluk Analizi")
+    occ = occupancy_frame(d1, d2)
+    if occ.empty:
+        st.info("Bu aralıkta seans yok.")
+    else:
+        slot = occupancy_summary(occ, ["Gün", "Saat"])
+        st.caption("Gün × saat doluluk oranı (%) – kayıtlı / kapasite")
+        st.dataframe(slot["Doluluk %"].unstack("Saat"), use_container_width=True)
+        tab_course, tab_month, tab_slot = st.tabs(["Ders Bazında", "Ay Bazında", "Gün/Saat Detay"])
+        with tab_course:
+            st.dataframe(occupancy_summary(occ, ["Ders"]), use_container_width=True)
+        with tab_month:
+            by_month = occupancy_summary(occ, ["Ay", "Ders"])
+            st.line_chart(by_month["Doluluk %"].unstack("Ders"))
+            st.dataframe(by_month, use_container_width=True)
+        with tab_slot:
+            st.dataframe(slot, use_container_width=True)
+
+    st.subheader("Kohort Tutundurma")
     with get_session() as s:
-        d1 = st.date_input("Başlangıç", value=date.today())
-        d2 = st.date_input("Bitiş", value=date.today())
-        cash = s.exec(select(Payment).where(Payment.date_ >= d1, Payment.date_ <= d2, Payment.cleared == True, Payment.method == "cash")).all()  # noqa: E712
-        iban = s.exec(select(Payment).where(Payment.date_ >= d1, Payment.date_ <= d2, Payment.cleared == True, Payment.method == "iban")).all()  # noqa: E712
-        expenses = s.exec(select(Expense).where(Expense.date_ >= d1, Expense.date_ <= d2, Expense.paid_from == "cash")).all()
-
-    st.metric("Nakit Toplam", f"₺{sum(p.amount for p in cash):,.0f}")
-    st.metric("IBAN Toplam", f"₺{sum(p.amount for p in iban):,.0f}")
-    st.metric("Harcama (Kasadan)", f"₺{sum(e.amount for e in expenses):,.0f}")
-    with get_session() as s:
-        attends = s.exec(select(Enrollment).join(SessionModel).where(SessionModel.date >= d1, SessionModel.date <= d2, Enrollment.status == "attended")).all()
-    st.metric("Katılan Kişi (unique)", f"{len(set(a.person_id for a in attends))}")
+        courses = s.exec(select(Course).order_by(Course.name)).all()
+    c_sel = st.selectbox("Ders (ops)", [None] + courses, format_func=lambda c: "Tüm dersler" if c is None else c.name, key="cohort_course")
+    cohort = cohort_matrix(data_version(), c_sel.id if c_sel else None)
+    if cohort["retention"].empty:
+        st.info("Katılım verisi yok.")
+    else:
+        st.caption("Satır: ilk geliş ayı, sütun: geçen ay sayısı – o ay en az bir kez katılanların oranı (%)")
+        st.dataframe(cohort["retention"], use_container_width=True)
+        with st.expander("Kişi sayıları"):
+            st.dataframe(cohort["counts"], use_container_width=True)
+
+    st.subheader("Dışa Aktar")
+    col_k, col_f, col_b = st.columns([2, 1, 1])
+    with col_k:
+        kind = st.selectbox("Veri", list(EXPORT_KINDS), format_func=EXPORT_KINDS.get, key="export_kind")
+    with col_f:
+        fmt = st.selectbox("Format", ["csv", "parquet"], key="export_fmt")
+    with col_b:
+        prepare = st.button("📤 Hazırla", key="export_prepare")
+    if prepare:
+        st.session_state.pop("export_file", None)
+        try:
+            path = write_export(export_statement(kind, d1, d2), fmt)
+        except ImportError:
+            st.error("Parquet için pyarrow gerekli.")
+            st.caption("Not: `pip install pyarrow` kurulu olmalı.")
+        else:
+            # download_button veriyi zaten bellekte tutar; geçici dosya okunur okunmaz silinir
+            try:
+                with open(path, "rb") as fh:
+                    data = fh.read()
+            finally:
+                os.remove(path)
+            st.session_state["export_file"] = {"data": data, "name": f"{kind}_{d1}_{d2}.{fmt}", "fmt": fmt}
+    export_file = st.session_state.get("export_file")
+    if export_file:
+        st.download_button(
+            f"⬇️ {export_file['name']} ({len(export_file['data']) / 1024:,.0f} KB)",
+            data=export_file["data"], file_name=export_file["name"],
+            mime="text/csv" if export_file["fmt"] == "csv" else "application/octet-stream",
+            key="export_download",
+        )
 
 # --------- TAKVİM ---------
+STATUS_EMOJI = {'registered': '📝', 'attended': '✅', 'canceled': '❌', 'no_show': '👻', 'waitlist': '⏳'}
+
+def _render_calendar_session(item: dict, tag: str = ""):
+    """Takvimde tek seans kartı (iptal + katılımcı çıkarma); tag widget anahtarlarını görünüme göre ayırır."""
+    sid = item["id"]
+    participants = item["participants"]
+    with st.expander(f"🎨 {item['course']} - {item['start'].strftime('%H:%M')}-{item['end'].strftime('%H:%M')} ({item['taken']}/{item['capacity']} kişi)"):
+        col1, col2, col3 = st.columns([3, 3, 2])
+        with col1:
+            st.write(f"**Kapasite:** {item['capacity']}")
+            st.write(f"**Kayıtlı:** {item['taken']}/{item['capacity']}")
+            if item["notes"]:
+                st.write(f"**Seans Notu:** {item['notes']}")
+
+        with col2:
+            st.write(f"**Fiyat:** ₺{item['price']}")
+
+        with col3:
+            if st.button("🗑️ Seansı İptal Et", key=f"cancel_{tag}session_{sid}", type="secondary"):
+                st.session_state[f"confirm_cancel_{tag}session_{sid}"] = True
+
+        # Session cancellation confirmation
+        if st.session_state.get(f"confirm_cancel_{tag}session_{sid}"):
+            st.error(f"**Bu seansı tamamen iptal etmek istediğinizden emin misiniz?**")
+            st.write(f"📅 {item['date'].strftime('%d %B %Y')} - {item['start'].strftime('%H:%M')}-{item['end'].strftime('%H:%M')}")
+            st.write(f"⚠️ Bu işlem geri alınamaz. Seansta kayıtlı {len(participants)} kişi çıkarılacak ve seans silinecek.")
+
+            col_yes, col_no = st.columns(2)
+            with col_yes:
+                if st.button("✅ Evet, İptal Et", key=f"confirm_cancel_{tag}yes_{sid}", type="primary"):
+                    with get_session() as cancel_s:
+                        # Delete the session with all its enrollments
+                        cancel_session(cancel_s, sid)
+                        cancel_s.commit()
+                        st.success(f"Seans başarıyla iptal edildi!")
+                        del st.session_state[f"confirm_cancel_{tag}session_{sid}"]
+                        st.rerun()
+
+            with col_no:
+                if st.button("❌ Hayır, İptal Etme", key=f"confirm_cancel_{tag}no_{sid}"):
+                    del st.session_state[f"confirm_cancel_{tag}session_{sid}"]
+                    st.rerun()
+
+        if not participants:
+            st.info("Bu seansa henüz kimse kayıt olmamış.")
+            return
+        st.write("**Katılımcılar:**")
+        for i, p in enumerate(participants, 1):
+            eid = p["enrollment_id"]
+            # Create columns for person info and remove button
+            col_person, col_remove = st.columns([10, 1])
+
+            with col_person:
+                person_info = f"{i}. {STATUS_EMOJI.get(p['status'], '📝')} **{p['name']}**"
+                if p["phone"]:
+                    person_info += f" - {p['phone']}"
+                # Show group label if any
+                if p["group_label"]:
+                    person_info += f" - 🏷️ *{p['group_label']}*"
+                # Show enrollment notes if any
+                if p["note"]:
+                    person_info += f"\n   💭 *{p['note']}*"
+                # Show person notes if any
+                if p["person_notes"]:
+                    person_info += f"\n   📝 *Kişi Notu: {p['person_notes']}*"
+                st.markdown(person_info)
+
+            with col_remove:
+                if st.button("🗑️", key=f"remove_{tag}enrollment_{eid}", help="Kayıttan Çıkar"):
+                    st.session_state[f"confirm_remove_{tag}enrollment_{eid}"] = True
+
+            # Confirmation dialog for removal
+            if st.session_state.get(f"confirm_remove_{tag}enrollment_{eid}"):
+                st.error(f"**{p['name']}** kişisini bu seanstan çıkarmak istediğinizden emin misiniz?")
+
+                col_yes, col_no = st.columns(2)
+                with col_yes:
+                    if st.button("✅ Evet, Çıkar", key=f"confirm_remove_{tag}yes_{eid}", type="primary"):
+                        with get_session() as remove_session:
+                            # Find and delete the enrollment
+                            enrollment_to_remove = remove_session.get(Enrollment, eid)
+                            if enrollment_to_remove:
+                                remove_enrollment(remove_session, enrollment_to_remove)
+                                remove_session.commit()
+                                st.success(f"{p['name']} seansdan çıkarıldı!")
+                                del st.session_state[f"confirm_remove_{tag}enrollment_{eid}"]
+                                st.rerun()
+
+                with col_no:
+                    if st.button("❌ Hayır, İptal", key=f"confirm_remove_{tag}no_{eid}"):
+                        del st.session_state[f"confirm_remove_{tag}enrollment_{eid}"]
+                        st.rerun()
+
+def _render_calendar_day(d: date, items: list, note: Optional[str], tag: str):
+    st.write(f"### {d.strftime('%d %B %Y (%A)')}")
+    if note:
+        st.info(f"📝 {note}")
+    for item in items:
+        _render_calendar_session(item, tag=tag)
+
+def _calendar_week_view():
+    """Haftalık görünüm: yalnızca görünen hafta yüklenir, komşu haftalar cache'e önceden alınır."""
+    if "cal_week_start" not in st.session_state:
+        st.session_state.cal_week_start = week_start(date.today())
+    start = st.session_state.cal_week_start
+
+    col_prev, col_today, col_next = st.columns(3)
+    with col_prev:
+        if st.button("⬅️ Önceki Hafta", key="cal_week_prev"):
+            st.session_state.cal_week_start = start - timedelta(days=7)
+            st.rerun()
+    with col_today:
+        if st.button("📍 Bu Hafta", key="cal_week_today"):
+            st.session_state.cal_week_start = week_start(date.today())
+            st.rerun()
+    with col_next:
+        if st.button("Sonraki Hafta ➡️", key="cal_week_next"):
+            st.session_state.cal_week_start = start + timedelta(days=7)
+            st.rerun()
+
+    end = start + timedelta(days=6)
+    version = data_version()
+    week = calendar_range_index(start, end, version)
+    st.subheader(f"📅 {start.strftime('%d %B')} – {end.strftime('%d %B %Y')}")
+    if not week["sessions"] and not week["notes"]:
+        st.info("Bu hafta seans bulunmamaktadır.")
+    for i in range(7):
+        d = start + timedelta(days=i)
+        if d in week["sessions"] or d in week["notes"]:
+            _render_calendar_day(d, week["sessions"].get(d, []), week["notes"].get(d), tag="week_")
+
+    # önceki/sonraki hafta tıklaması cache'ten gelsin
+    for offset in (-7, 7):
+        calendar_range_index(start + timedelta(days=offset), end + timedelta(days=offset), version)
+
+def _calendar_agenda_view():
+    """Ajanda: bugünden itibaren haftalık pencereler; "sonraki hafta" yalnızca yeni pencereyi yükler."""
+    if "cal_agenda_weeks" not in st.session_state:
+        st.session_state.cal_agenda_weeks = 1
+    weeks = st.session_state.cal_agenda_weeks
+    today = date.today()
+    version = data_version()
+
+    last = today + timedelta(days=7 * weeks - 1)
+    st.subheader(f"🗓️ {today.strftime('%d %B')} – {last.strftime('%d %B %Y')}")
+    shown = 0
+    for w in range(weeks):
+        d1 = today + timedelta(days=7 * w)
+        window = calendar_range_index(d1, d1 + timedelta(days=6), version)
+        for d in sorted(window["sessions"].keys() | window["notes"].keys()):
+            _render_calendar_day(d, window["sessions"].get(d, []), window["notes"].get(d), tag="agenda_")
+            shown += 1
+    if not shown:
+        st.info("Bu aralıkta seans bulunmamaktadır.")
+
+    if st.button("⬇️ Sonraki Haftayı Yükle", key="cal_agenda_more"):
+        st.session_state.cal_agenda_weeks = weeks + 1
+        st.rerun()
+
+    # bir sonraki pencere önceden cache'e alınır
+    d1 = today + timedelta(days=7 * weeks)
+    calendar_range_index(d1, d1 + timedelta(days=6), version)
+
 def page_calendar():
     st.header("📅 Takvim")
+
+    view = st.radio("Görünüm", ["Ay", "Hafta", "Ajanda"], horizontal=True, key="cal_view")
+    if view == "Hafta":
+        _calendar_week_view()
+        return
+    if view == "Ajanda":
+        _calendar_agenda_view()
+        return
     
     # Current month/year selection
     col1, col2 = st.columns(2)
     with col1:
-        selected_year = st.selectbox("Yıl", range(2024, 2027), index=1)  # Default 2025
+        years = calendar_years(data_version())
+        selected_year = st.selectbox("Yıl", years, index=years.index(date.today().year))
     with col2:
         selected_month = st.selectbox("Ay", range(1, 13), 
                                      index=datetime.now().month - 1,
                                      format_func=lambda x: calendar.month_name[x])
     
-    # Get sessions for the selected month
-    first_day = date(selected_year, selected_month, 1)
-    # Get last day of month
-    if selected_month == 12:
-        last_day = date(selected_year + 1, 1, 1) - timedelta(days=1)
-    else:
-        last_day = date(selected_year, selected_month + 1, 1) - timedelta(days=1)
-    
-    with get_session() as s:
-        # Get all sessions in the month
-        sessions = s.exec(select(SessionModel).where(
-            SessionModel.date >= first_day,
-            SessionModel.date <= last_day
-        )).all()
-        
-        # Get all courses
-        courses = {c.id: c for c in s.exec(select(Course)).all()}
-        
-        # Get all enrollments for these sessions
-        session_ids = [session.id for session in sessions]
-        enrollments = s.exec(select(Enrollment).where(
-            Enrollment.session_id.in_(session_ids)
-        )).all() if session_ids else []
-        
-        # Get all people for these enrollments
-        person_ids = [e.person_id for e in enrollments]
-        people = {p.id: p for p in s.exec(select(Person).where(
-            Person.id.in_(person_ids)
-        )).all()} if person_ids else {}
-        
-        # Get all daily notes for the month
-        try:
-            daily_notes = s.exec(select(DailyNote).where(
-                DailyNote.date_ >= first_day,
-                DailyNote.date_ <= last_day
-            )).all()
-            notes_by_date = {note.date_: note for note in daily_notes}
-        except Exception as e:
-            # If daily_note table doesn't exist yet, create empty dict
-            st.info("Günlük notlar henüz kullanılabilir değil. Uygulama yeniden başlatılıyor...")
-            notes_by_date = {}
-        
-    
-    # Group sessions by date
-    sessions_by_date = {}
-    for session in sessions:
-        session_date = session.date
-        if session_date not in sessions_by_date:
-            sessions_by_date[session_date] = {}
-        
-        session_key = session.id
-        course = courses.get(session.course_id)
-        if not course:
-            continue
-            
-        sessions_by_date[session_date][session_key] = {
-            'session': session,
-            'course': course,
-            'enrollments': []
-        }
-    
-    # Add enrollments to sessions
-    for enrollment in enrollments:
-        session_id = enrollment.session_id
-        person = people.get(enrollment.person_id)
-        
-        # Find the session in our grouped data
-        for session_date, sessions_data in sessions_by_date.items():
-            if session_id in sessions_data:
-                if person:
-                    sessions_data[session_id]['enrollments'].append({
-                        'enrollment': enrollment,
-                        'person': person
-                    })
-                break
+    # Ay indeksi cache'ten: gün tıklamaları DB'ye gitmez, yazımlar veri sürümünü artırınca yenilenir
+    month_index = calendar_month_index(selected_year, selected_month, data_version())
+    sessions_by_date = month_index["sessions"]
+    notes_by_date = month_index["notes"]
     
     # Create calendar display
     cal = calendar.monthcalendar(selected_year, selected_month)
@@ -1629,9 +3830,8 @@ def page_calendar():
     """)
     
     # Calendar header (days of week)
-    days = ['Pazartesi', 'Salı', 'Çarşamba', 'Perşembe', 'Cuma', 'Cumartesi', 'Pazar']
     cols = st.columns(7)
-    for i, day in enumerate(days):
+    for i, day in enumerate(WEEKDAYS_TR):
         with cols[i]:
             st.markdown(f"**{day}**")
     
@@ -1676,136 +3876,16 @@ def page_calendar():
         st.subheader(f"📅 {selected_date.strftime('%d %B %Y')} Seansları")
         
         if selected_date in sessions_by_date:
-            for session_key, session_data in sessions_by_date[selected_date].items():
-                session = session_data['session']
-                course = session_data['course']
-                enrollments = session_data['enrollments']
-                
-                with st.expander(f"🎨 {course.name} - {session.start_time.strftime('%H:%M')}-{session.end_time.strftime('%H:%M')}"):
-                    col1, col2, col3 = st.columns([3, 3, 2])
-                    with col1:
-                        st.write(f"**Kapasite:** {session.capacity}")
-                        st.write(f"**Kayıtlı:** {len(enrollments)}")
-                        if session.notes:
-                            st.write(f"**Seans Notu:** {session.notes}")
-                    
-                    with col2:
-                        if session.price_override:
-                            st.write(f"**Fiyat:** ₺{session.price_override}")
-                        else:
-                            st.write(f"**Fiyat:** ₺{course.default_price}")
-                    
-                    with col3:
-                        if st.button("🗑️ Seansı İptal Et", key=f"cancel_session_{session.id}", type="secondary"):
-                            st.session_state[f"confirm_cancel_session_{session.id}"] = True
-                    
-                    # Session cancellation confirmation
-                    if st.session_state.get(f"confirm_cancel_session_{session.id}"):
-                        st.error(f"**Bu seansı tamamen iptal etmek istediğinizden emin misiniz?**")
-                        st.write(f"📅 {session.date.strftime('%d %B %Y')} - {session.start_time.strftime('%H:%M')}-{session.end_time.strftime('%H:%M')}")
-                        st.write(f"⚠️ Bu işlem geri alınamaz. Seansta kayıtlı {len(enrollments)} kişi çıkarılacak ve seans silinecek.")
-                        
-                        col_yes, col_no = st.columns(2)
-                        with col_yes:
-                            if st.button("✅ Evet, İptal Et", key=f"confirm_cancel_yes_{session.id}", type="primary"):
-                                with get_session() as cancel_session:
-                                    # Delete all enrollments for this session
-                                    session_enrollments = cancel_session.exec(
-                                        select(Enrollment).where(Enrollment.session_id == session.id)
-                                    ).all()
-                                    
-                                    for enrollment in session_enrollments:
-                                        cancel_session.delete(enrollment)
-                                    
-                                    # Delete the session
-                                    session_to_delete = cancel_session.get(SessionModel, session.id)
-                                    if session_to_delete:
-                                        cancel_session.delete(session_to_delete)
-                                    
-                                    cancel_session.commit()
-                                    st.success(f"Seans başarıyla iptal edildi!")
-                                    del st.session_state[f"confirm_cancel_session_{session.id}"]
-                                    st.rerun()
-                        
-                        with col_no:
-                            if st.button("❌ Hayır, İptal Etme", key=f"confirm_cancel_no_{session.id}"):
-                                del st.session_state[f"confirm_cancel_session_{session.id}"]
-                                st.rerun()
-                    
-                    if enrollments:
-                        st.write("**Katılımcılar:**")
-                        for i, enroll_data in enumerate(enrollments, 1):
-                            enrollment = enroll_data['enrollment']
-                            person = enroll_data['person']
-                            
-                            status_emoji = {
-                                'registered': '📝',
-                                'attended': '✅', 
-                                'canceled': '❌',
-                                'no_show': '👻'
-                            }.get(enrollment.status, '📝')
-                            
-                            # Create columns for person info and remove button
-                            col_person, col_remove = st.columns([10, 1])
-                            
-                            with col_person:
-                                person_info = f"{i}. {status_emoji} **{person.name}**"
-                                if person.phone:
-                                    person_info += f" - {person.phone}"
-                                
-                                # Show group label if any
-                                if enrollment.group_label:
-                                    person_info += f" - 🏷️ *{enrollment.group_label}*"
-                                
-                                # Show enrollment notes if any
-                                if enrollment.note:
-                                    person_info += f"\n   💭 *{enrollment.note}*"
-                                
-                                # Show person notes if any  
-                                if person.notes:
-                                    person_info += f"\n   📝 *Kişi Notu: {person.notes}*"
-                                
-                                st.markdown(person_info)
-                            
-                            with col_remove:
-                                if st.button("🗑️", key=f"remove_enrollment_{enrollment.id}", help="Kayıttan Çıkar"):
-                                    st.session_state[f"confirm_remove_enrollment_{enrollment.id}"] = True
-                            
-                            # Confirmation dialog for removal
-                            if st.session_state.get(f"confirm_remove_enrollment_{enrollment.id}"):
-                                st.error(f"**{person.name}** kişisini bu seanstan çıkarmak istediğinizden emin misiniz?")
-                                
-                                col_yes, col_no = st.columns(2)
-                                with col_yes:
-                                    if st.button("✅ Evet, Çıkar", key=f"confirm_remove_yes_{enrollment.id}", type="primary"):
-                                        with get_session() as remove_session:
-                                            # Find and delete the enrollment
-                                            enrollment_to_remove = remove_session.get(Enrollment, enrollment.id)
-                                            if enrollment_to_remove:
-                                                remove_session.delete(enrollment_to_remove)
-                                                remove_session.commit()
-                                                st.success(f"{person.name} seansdan çıkarıldı!")
-                                                del st.session_state[f"confirm_remove_enrollment_{enrollment.id}"]
-                                                st.rerun()
-                                
-                                with col_no:
-                                    if st.button("❌ Hayır, İptal", key=f"confirm_remove_no_{enrollment.id}"):
-                                        del st.session_state[f"confirm_remove_enrollment_{enrollment.id}"]
-                                        st.rerun()
-                    else:
-                        st.info("Bu seansa henüz kimse kayıt olmamış.")
+            for item in sessions_by_date[selected_date]:
+                _render_calendar_session(item)
         else:
             st.info("Bu tarihte seans bulunmamaktadır.")
         
         # Show daily note if exists (read-only)
-        try:
-            existing_note = s.exec(select(DailyNote).where(DailyNote.date_ == selected_date)).first()
-            if existing_note:
-                st.markdown("---")
-                st.subheader(f"� {selected_date.strftime('%d %B %Y')} Günlük Not")
-                st.info(existing_note.note)
-        except Exception:
-            pass  # Daily note table might not exist yet
+        if selected_date in notes_by_date:
+            st.markdown("---")
+            st.subheader(f"📝 {selected_date.strftime('%d %B %Y')} Günlük Not")
+            st.info(notes_by_date[selected_date])
 
         # Button to clear selection and show all sessions
         if st.button("🔄 Tüm Seansları Göster"):
@@ -1819,126 +3899,8 @@ def page_calendar():
         if sessions_by_date:
             for session_date in sorted(sessions_by_date.keys()):
                 st.write(f"### {session_date.strftime('%d %B %Y (%A)')}")
-                
-                for session_key, session_data in sessions_by_date[session_date].items():
-                    session = session_data['session']
-                    course = session_data['course']
-                    enrollments = session_data['enrollments']
-                    
-                    with st.expander(f"🎨 {course.name} - {session.start_time.strftime('%H:%M')}-{session.end_time.strftime('%H:%M')} ({len(enrollments)} kişi)"):
-                        col1, col2, col3 = st.columns([3, 3, 2])
-                        with col1:
-                            st.write(f"**Kapasite:** {session.capacity}")
-                            st.write(f"**Kayıtlı:** {len(enrollments)}")
-                            if session.notes:
-                                st.write(f"**Seans Notu:** {session.notes}")
-                        
-                        with col2:
-                            if session.price_override:
-                                st.write(f"**Fiyat:** ₺{session.price_override}")
-                            else:
-                                st.write(f"**Fiyat:** ₺{course.default_price}")
-                        
-                        with col3:
-                            if st.button("🗑️ Seansı İptal Et", key=f"cancel_all_session_{session.id}", type="secondary"):
-                                st.session_state[f"confirm_cancel_all_session_{session.id}"] = True
-                        
-                        # Session cancellation confirmation
-                        if st.session_state.get(f"confirm_cancel_all_session_{session.id}"):
-                            st.error(f"**Bu seansı tamamen iptal etmek istediğinizden emin misiniz?**")
-                            st.write(f"📅 {session.date.strftime('%d %B %Y')} - {session.start_time.strftime('%H:%M')}-{session.end_time.strftime('%H:%M')}")
-                            st.write(f"⚠️ Bu işlem geri alınamaz. Seansta kayıtlı {len(enrollments)} kişi çıkarılacak ve seans silinecek.")
-                            
-                            col_yes, col_no = st.columns(2)
-                            with col_yes:
-                                if st.button("✅ Evet, İptal Et", key=f"confirm_cancel_all_yes_{session.id}", type="primary"):
-                                    with get_session() as cancel_session:
-                                        # Delete all enrollments for this session
-                                        session_enrollments = cancel_session.exec(
-                                            select(Enrollment).where(Enrollment.session_id == session.id)
-                                        ).all()
-                                        
-                                        for enrollment in session_enrollments:
-                                            cancel_session.delete(enrollment)
-                                        
-                                        # Delete the session
-                                        session_to_delete = cancel_session.get(SessionModel, session.id)
-                                        if session_to_delete:
-                                            cancel_session.delete(session_to_delete)
-                                        
-                                        cancel_session.commit()
-                                        st.success(f"Seans başarıyla iptal edildi!")
-                                        del st.session_state[f"confirm_cancel_all_session_{session.id}"]
-                                        st.rerun()
-                            
-                            with col_no:
-                                if st.button("❌ Hayır, İptal Etme", key=f"confirm_cancel_all_no_{session.id}"):
-                                    del st.session_state[f"confirm_cancel_all_session_{session.id}"]
-                                    st.rerun()
-                        
-                        if enrollments:
-                            st.write("**Katılımcılar:**")
-                            for i, enroll_data in enumerate(enrollments, 1):
-                                enrollment = enroll_data['enrollment']
-                                person = enroll_data['person']
-                                
-                                status_emoji = {
-                                    'registered': '📝',
-                                    'attended': '✅', 
-                                    'canceled': '❌',
-                                    'no_show': '👻'
-                                }.get(enrollment.status, '📝')
-                                
-                                # Create columns for person info and remove button
-                                col_person, col_remove = st.columns([10, 1])
-                                
-                                with col_person:
-                                    person_info = f"{i}. {status_emoji} **{person.name}**"
-                                    if person.phone:
-                                        person_info += f" - {person.phone}"
-                                    
-                                    # Show group label if any
-                                    if enrollment.group_label:
-                                        person_info += f" - 🏷️ *{enrollment.group_label}*"
-                                    
-                                    # Show enrollment notes if any
-                                    if enrollment.note:
-                                        person_info += f"\n   💭 *{enrollment.note}*"
-                                    
-                                    # Show person notes if any  
-                                    if person.notes:
-                                        person_info += f"\n   📝 *Kişi Notu: {person.notes}*"
-                                    
-                                    st.markdown(person_info)
-                                
-                                with col_remove:
-                                    if st.button("🗑️", key=f"remove_all_enrollment_{enrollment.id}", help="Kayıttan Çıkar"):
-                                        st.session_state[f"confirm_remove_all_enrollment_{enrollment.id}"] = True
-                                
-                                # Confirmation dialog for removal
-                                if st.session_state.get(f"confirm_remove_all_enrollment_{enrollment.id}"):
-                                    st.error(f"**{person.name}** kişisini bu seanstan çıkarmak istediğinizden emin misiniz?")
-                                    
-                                    col_yes, col_no = st.columns(2)
-                                    with col_yes:
-                                        if st.button("✅ Evet, Çıkar", key=f"confirm_remove_all_yes_{enrollment.id}", type="primary"):
-                                            with get_session() as remove_session:
-                                                # Find and delete the enrollment
-                                                enrollment_to_remove = remove_session.get(Enrollment, enrollment.id)
-                                                if enrollment_to_remove:
-                                                    remove_session.delete(enrollment_to_remove)
-                                                    remove_session.commit()
-                                                    st.success(f"{person.name} seansdan çıkarıldı!")
-                                                    del st.session_state[f"confirm_remove_all_enrollment_{enrollment.id}"]
-                                                    st.rerun()
-                                    
-                                    with col_no:
-                                        if st.button("❌ Hayır, İptal", key=f"confirm_remove_all_no_{enrollment.id}"):
-                                            del st.session_state[f"confirm_remove_all_enrollment_{enrollment.id}"]
-                                            st.rerun()
-                        else:
-                            st.info("Bu seansa henüz kimse kayıt olmamış.")
-                
+                for item in sessions_by_date[session_date]:
+                    _render_calendar_session(item, tag="all_")
                 st.markdown("---")
         else:
             st.info(f"{calendar.month_name[selected_month]} {selected_year} ayında hiç seans bulunmamaktadır.")
@@ -1948,6 +3910,7 @@ def page_import():
     st.header("📥 İçe Aktar (Excel)")
     st.info("Şablondaki iki sayfayı içe alır: **Eylül 2025 Takvim** (seanslar) ve **Öğrenci Listesi** (kişiler).")
 
+    allow_similar = st.checkbox("Benzer isimli öğrencileri de ekle", help="Yalnızca isim benzerliği olan satırlar eklenir; aynı telefonlu satırlar yine atlanır.")
     f = st.file_uploader("Excel seç (.xlsx)", type=["xlsx"])
     if not f:
         return
@@ -1979,26 +3942,26 @@ def page_import():
             st.warning("Öğrenci Listesi sayfasında 'Ad Soyad' bulunamadı.")
         else:
             with get_session() as s:
-                added = 0
-                for _, row in df_p.iterrows():
+                added, skipped = 0, []
+                for idx, row in df_p.iterrows():
                     name = str(row.get(name_col, "") or "").strip()
                     if not name:
                         continue
                     phone = str(row.get(phone_col, "") or "").strip() or None
                     ig = str(row.get(ig_col, "") or "").strip() or None
                     notes = str(row.get(note_col, "") or "").strip() or None
-                    exists = None
-                    # Check for duplicate by phone or name (case insensitive)
-                    if phone:
-                        exists = s.exec(select(Person).where(Person.phone == phone)).first()
-                    if not exists:
-                        exists = s.exec(select(Person).where(func.lower(Person.name) == func.lower(name))).first()
-                    if exists:
+                    dups = find_duplicates(s, name, phone, limit=1)
+                    if dups and (is_hard_duplicate(dups) or not allow_similar):
+                        p, score, reason = dups[0]
+                        skipped.append({"Satır": idx + 2, "Ad Soyad": name, "Telefon": phone or "-",
+                                        "Eşleşen Kayıt": f"{p.name} (#{p.id})", "Sebep": f"%{score * 100:.0f} {reason}"})
                         continue
-                    s.add(Person(name=name, phone=phone, instagram=ig, notes=notes, first_visit=date.today()))
+                    add_person(s, name, phone=phone, instagram=ig, notes=notes, first_visit=date.today())
                     added += 1
                 s.commit()
-            st.success(f"Öğrenci Listesi: {added} kişi eklendi")
+            st.success(f"Öğrenci Listesi: {added} kişi eklendi, {len(skipped)} satır mükerrer olabileceği için atlandı")
+            if skipped:
+                st.dataframe(pd.DataFrame(skipped), hide_index=True, use_container_width=True)
 
     # --- Seanslar
     if "Eylül 2025 Takvim" in xls.sheet_names:
@@ -2226,6 +4189,7 @@ def main():
     load_theme()
     init_db()
     seed_minimal()
+    auto_close_cash(date.today())
 
     st.sidebar.title("🏺 Nehir Seramik")
     st.sidebar.write(f"Hoş geldin, {st.session_state.get('username', 'Kullanıcı')}!")
@@ -2240,21 +4204,16 @@ def main():
             q_name  = st.text_input("Ad Soyad")
             q_phone = st.text_input("Telefon")
             q_ig    = st.text_input("Instagram")
+            q_force = st.checkbox("Benzer isim olsa da kaydet", key="quick_person_force")
             q_ok    = st.form_submit_button("Kaydet")
         if q_ok and q_name.strip():
             with get_session() as s:
-                # Duplicate check - case insensitive
-                existing = s.exec(
-                    select(Person).where(
-                        (func.lower(Person.name) == func.lower(q_name.strip())) | 
-                        (Person.phone == q_phone.strip() if q_phone.strip() else False)
-                    )
-                ).first()
-                
-                if existing:
-                    st.sidebar.warning(f"Bu kişi zaten kayıtlı: {existing.name}")
+                dups = find_duplicates(s, q_name.strip(), q_phone.strip() or None, limit=1)
+                if dups and (is_hard_duplicate(dups) or not q_force):
+                    st.sidebar.warning(f"Bu kişi zaten kayıtlı olabilir: {dups[0][0].name}"
+                                       + ("" if is_hard_duplicate(dups) else " – farklı biriyse 'Benzer isim olsa da kaydet'i işaretleyin."))
                 else:
-                    s.add(Person(name=q_name.strip(), phone=(q_phone.strip() or None), instagram=(q_ig.strip() or None), first_visit=date.today()))
+                    add_person(s, q_name.strip(), phone=(q_phone.strip() or None), instagram=(q_ig.strip() or None), first_visit=date.today())
                     s.commit()
                     st.sidebar.success("Öğrenci eklendi")
 
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Kayıt servisi eşzamanlılık testi
+
+Çok sayıda eşzamanlı kaydı tek bir seansa yükler ve kapasitenin aşılmadığını,
+aynı kişinin iki kez kaydolmadığını doğrular.
+
+Kullanım:
+    python bench_enrollment.py                                  # geçici SQLite veritabanı
+    python bench_enrollment.py --workers 32 --people 200 --capacity 16
+    python bench_enrollment.py --naive                          # eski kontrol-sonra-ekle akışı (taşmayı gösterir)
+    DATABASE_URL=postgresql://... python bench_enrollment.py    # test verisini yazar, sonunda siler
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time as dtime
+
+TEMP_DB = None
+if not os.getenv("DATABASE_URL"):
+    TEMP_DB = tempfile.NamedTemporaryFile(prefix="bench_enrollment_", suffix=".db", delete=False).name
+    os.environ["DATABASE_URL"] = f"sqlite:///{TEMP_DB}"
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import app  # noqa: E402  (DATABASE_URL import'tan önce ayarlanmalı)
+from sqlmodel import select, func, delete  # noqa: E402
+
+
+def setup(capacity: int, people: int):
+    with app.get_session() as s:
+        course = app.Course(name="Bench – Kurs", default_price=100.0, default_capacity=capacity)
+        s.add(course)
+        s.flush()
+        sess = app.SessionModel(course_id=course.id, date=date.today(), start_time=dtime(10, 0),
+                                end_time=dtime(12, 0), capacity=capacity, notes="bench")
+        s.add(sess)
+        persons = [app.Person(name=f"Bench Kişi {i:04d}") for i in range(people)]
+        s.add_all(persons)
+        s.commit()
+        return course.id, sess.id, [p.id for p in persons]
+
+
+def teardown(course_id: int, session_id: int, person_ids: list):
+    with app.get_session() as s:
+        s.exec(delete(app.Enrollment).where(app.Enrollment.session_id == session_id))
+        s.exec(delete(app.SessionModel).where(app.SessionModel.id == session_id))
+        s.exec(delete(app.Course).where(app.Course.id == course_id))
+        s.exec(delete(app.PersonNameToken).where(app.PersonNameToken.person_id.in_(person_ids)))
+        s.exec(delete(app.Person).where(app.Person.id.in_(person_ids)))
+        s.commit()
+
+
+def naive_enroll(person_id: int, session_id: int, think: float):
+    """Eski akış: önce say, sonra ekle (kilit yok)."""
+    with app.get_session() as s:
+        sess = s.get(app.SessionModel, session_id)
+        taken = s.exec(
+            select(func.count(app.Enrollment.id))
+            .where(app.Enrollment.session_id == session_id, app.Enrollment.status.in_(app.ACTIVE_STATUSES))
+        ).one()
+        if taken >= sess.capacity:
+            raise ValueError("Kapasite dolu – Owner onayı gerekir.")
+        time.sleep(think)  # telefon/ağ gecikmesi: kontrol ile INSERT arası
+        s.add(app.Enrollment(person_id=person_id, session_id=session_id))
+        try:
+            s.commit()
+        except app.IntegrityError:
+            raise ValueError("Bu kişi zaten seansa kayıtlı.")
+
+
+def run(args) -> bool:
+    app.init_db()
+    course_id, session_id, person_ids = setup(args.capacity, args.people)
+    # ilk --dupes kişi iki kez denenir: unique kısıtı da sınanır
+    attempts = person_ids + person_ids[:args.dupes]
+    start = threading.Event()  # ilk dalga aynı anda başlasın
+    stats = {"ok": 0, "full": 0, "dupe": 0, "error": 0}
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(pid):
+        start.wait()
+        t0 = time.perf_counter()
+        try:
+            if args.naive:
+                naive_enroll(pid, session_id, args.think_ms / 1000)
+            else:
+                app.enroll_person(pid, session_id)
+            key = "ok"
+        except ValueError as exc:
+            key = "dupe" if "zaten" in str(exc) else "full"
+        except Exception as exc:  # kilit zaman aşımı vb.
+            key = "error"
+            print(f"❌ person#{pid}: {exc}")
+        with lock:
+            stats[key] += 1
+            latencies.append(time.perf_counter() - t0)
+
+    print(f"🚀 {len(attempts)} kayıt denemesi, {args.workers} eşzamanlı işçi, kapasite {args.capacity} "
+          f"({'naive' if args.naive else 'enroll_person'}, {app.ENGINE.dialect.name})")
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(worker, pid) for pid in attempts]
+        time.sleep(0.2)  # iş parçacıkları start.wait()'te toplansın
+        t0 = time.perf_counter()
+        start.set()
+        for f in futures:
+            f.result()
+    elapsed = time.perf_counter() - t0
+
+    with app.get_session() as s:
+        active = s.exec(
+            select(func.count(app.Enrollment.id))
+            .where(app.Enrollment.session_id == session_id, app.Enrollment.status.in_(app.ACTIVE_STATUSES))
+        ).one()
+        dup_rows = s.exec(
+            select(app.Enrollment.person_id)
+            .where(app.Enrollment.session_id == session_id)
+            .group_by(app.Enrollment.person_id)
+            .having(func.count() > 1)
+        ).all()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+    print(f"⏱️  {elapsed:.2f} sn · {len(attempts) / elapsed:.0f} deneme/sn · p50 {p50:.1f} ms · p95 {p95:.1f} ms")
+    print(f"📊 başarılı {stats['ok']} · kapasite dolu {stats['full']} · zaten kayıtlı {stats['dupe']} · hata {stats['error']}")
+    print(f"🪑 seanstaki aktif kayıt: {active}/{args.capacity} · mükerrer kişi: {len(dup_rows)}")
+
+    if not args.keep:
+        teardown(course_id, session_id, person_ids)
+
+    passed = active <= args.capacity and not dup_rows and stats["ok"] == active
+    print("✅ Taşma yok" if passed else "❌ Kapasite aşıldı veya mükerrer kayıt oluştu!")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Eşzamanlı kayıt / kapasite testi")
+    parser.add_argument("--workers", type=int, default=16, help="eşzamanlı iş parçacığı sayısı")
+    parser.add_argument("--people", type=int, default=100, help="kayıt denemesi yapacak kişi sayısı")
+    parser.add_argument("--capacity", type=int, default=16, help="seans kapasitesi")
+    parser.add_argument("--dupes", type=int, default=10, help="iki kez denenecek kişi sayısı")
+    parser.add_argument("--naive", action="store_true", help="kilitsiz eski akışı çalıştır (karşılaştırma)")
+    parser.add_argument("--think-ms", type=float, default=5.0, help="naive modda kontrol ile INSERT arası gecikme")
+    parser.add_argument("--keep", action="store_true", help="test verisini silme")
+    ok = run(parser.parse_args())
+    if TEMP_DB:
+        app.ENGINE.dispose()
+        os.unlink(TEMP_DB)
+    sys.exit(0 if ok else 1)
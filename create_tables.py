@@ -5,6 +5,7 @@ Bu dosyayı bir kez çalıştırarak daily_note tablosunu manuel oluşturun.
 """
 
 import os
+import sys
 from sqlmodel import SQLModel, create_engine, text, Session
 from datetime import date, datetime
 
@@ -95,7 +96,8 @@ def verify_all_tables():
     required_tables = [
         'person', 'course', 'sessionmodel', 'enrollment', 
         'payment', 'expense', 'charge', 'piece', 
-        'material', 'stock_movement', 'daily_note'
+        'material', 'stock_movement', 'daily_note', 'wallet_balance',
+        'cash_closing', 'inventory_snapshot', 'daily_kpi', 'person_name_token'
     ]
     
     try:
@@ -118,7 +120,54 @@ def verify_all_tables():
         print(f"❌ Tablo kontrolü hatası: {e}")
         return False
 
+def reconcile_wallets():
+    """Cüzdan projeksiyonunu ham defterden yeniden kur ve farkları raporla"""
+    print("\n💰 Cüzdan mutabakatı yapılıyor...")
+    from app import init_db, reconcile_wallet_balances
+
+    init_db()
+    drift = reconcile_wallet_balances()
+    for row in drift:
+        print(f"⚠️  person#{row['person_id']}: kayıtlı {row['stored']} / defter {row['ledger']} (fark {row['diff']})")
+    print(f"📊 Sonuç: {len(drift)} kişide fark düzeltildi")
+    return drift
+
+def build_snapshots():
+    """Kapanmış aylar için envanter snapshot'larını yaz"""
+    print("\n📦 Ay sonu envanter snapshot'ları yazılıyor...")
+    from app import init_db, build_inventory_snapshots
+
+    init_db()
+    n = build_inventory_snapshots()
+    print(f"📊 Sonuç: {n} snapshot satırı yazıldı")
+    return n
+
+def repair_seat_counts():
+    """Seans koltuk sayaçlarını kayıtlardan yeniden hesapla ve sapmaları raporla"""
+    print("\n🪑 Seans sayaçları onarılıyor...")
+    from app import init_db, get_session, refresh_seat_counts, seat_count_drift
+
+    init_db()
+    drift = seat_count_drift()
+    for row in drift:
+        print(f"⚠️  seans#{row['session_id']}: kayıtlı {row['stored']} / gerçek {row['actual']}")
+    with get_session() as s:
+        n = refresh_seat_counts(s)
+        s.commit()
+    print(f"📊 Sonuç: {n} seans yeniden sayıldı, {len(drift)} seansta fark vardı")
+    return drift
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "reconcile":
+        reconcile_wallets()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "snapshots":
+        build_snapshots()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "seats":
+        repair_seat_counts()
+        sys.exit(0)
+
     print("🏺 Nehir Seramik - Tablo Oluşturma Scripti")
     print(f"🔗 Database: {DATABASE_URL}")
     print("-" * 50)